@@ -0,0 +1,169 @@
+from download import DataDownloader
+import instrument
+import pandas as pd
+import os, time, types, pickle, hashlib
+
+class AggregateCache:
+
+    #results of aggregating functions kept on disk and keyed by function, its parameters and fingerprint
+    #of region caches, so reports are drawn from stored summaries until the underlying data changes,
+    #least recently used entries are removed once the folder grows over max_size bytes
+
+    #entries are pickles named by hash of their key
+    entry_suffix = '.pkl'
+
+    def __init__(self, downloader = None, regions = None, folder = None, max_size = 64 * 2**20, load_all = False):
+
+        self.downloader = downloader if downloader is not None else DataDownloader()
+        self.regions = regions
+        self.folder = folder if folder is not None else self.downloader.folder + '/aggregates'
+        self.max_size = max_size
+
+        #counters of lookups since creation
+        self.hits = 0
+        self.misses = 0
+
+        #data loaded for computing missing entries, shared by all of them, with load_all
+        #all columns are loaded on the first miss so that other entries never load again
+        self.loaded = dict()
+        self.load_all = load_all
+        self.load_seconds = 0.0
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def get(self, function, *args, source = "dataframe", columns = None, **kwargs):
+        #result of function(data, *args, **kwargs), where data are regions loaded as DataFrame by to_dataframe
+        #or as list by get_list if source is "list", computed only if not cached for current data,
+        #functions loading data on their own get the downloader with source "downloader"
+        path = self.entry_path(function, args, kwargs, source, columns, self.downloader.fingerprint(self.regions))
+        try:
+            with open(path, 'rb') as f:
+                result = pickle.load(f)
+            #mark entry as recently used
+            os.utime(path)
+            self.hits += 1
+            instrument.count("aggregate_cache_hits")
+            return result
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            instrument.count("aggregate_cache_misses")
+
+        data = self.load(source, columns)
+        with instrument.stage("aggregate." + function.__name__) as stage:
+            result = function(data, *args, **kwargs)
+            stage.rows = rows_of(data)
+
+        #loading can build missing caches, key is created again so the next lookup finds the entry
+        self.store(self.entry_path(function, args, kwargs, source, columns, self.downloader.fingerprint(self.regions)), result)
+        return result
+
+    def load(self, source, columns = None):
+        #data of regions, loaded once for each source and columns,
+        #once all columns are loaded as list everything else is taken from them
+        key = (source, None if columns is None else tuple(columns))
+        if self.load_all and ("list", None) not in self.loaded and source != "downloader":
+            start = time.perf_counter()
+            self.loaded[("list", None)] = self.downloader.get_list(self.regions)
+            self.load_seconds += time.perf_counter() - start
+        full = self.loaded.get(("list", None))
+        if key not in self.loaded:
+            start = time.perf_counter()
+            if source == "list" and full is not None:
+                self.loaded[key] = (list(columns), [full[1][full[0].index(column)] for column in columns])
+            elif source == "list":
+                self.loaded[key] = self.downloader.get_list(self.regions, columns=columns)
+            elif source == "dataframe" and full is not None:
+                self.loaded[key] = self.downloader.list_to_dataframe(self.load("list", columns) if columns is not None else full)
+            elif source == "dataframe":
+                self.loaded[key] = self.downloader.to_dataframe(self.regions, columns=columns)
+            elif source == "downloader":
+                self.loaded[key] = self.downloader
+            else:
+                raise ValueError("Unknown source {}".format(source))
+            self.load_seconds += time.perf_counter() - start
+        return self.loaded[key]
+
+    def entry_path(self, function, args, kwargs, source, columns, fingerprint):
+        #code of function and of its callees is part of the key so entries of changed function are not used
+        key = repr((function.__module__, function.__qualname__, code_key(function), args,
+                    sorted(kwargs.items()), source, columns, self.regions, fingerprint))
+        return self.folder + '/' + hashlib.sha1(key.encode()).hexdigest() + AggregateCache.entry_suffix
+
+    def store(self, path, result):
+        #write entry through temporary file so it's never read incomplete, then evict old entries
+        temporary = "{}.{}.tmp".format(path, os.getpid())
+        with open(temporary, 'wb') as f:
+            pickle.dump(result, f)
+        os.replace(temporary, path)
+        self.evict()
+
+    def evict(self):
+        #remove least recently used entries until size of the folder is at most max_size
+        evict_lru([self.folder + '/' + name for name in os.listdir(self.folder) if name.endswith(AggregateCache.entry_suffix)],
+                  self.max_size)
+
+    def clear(self):
+        for name in os.listdir(self.folder):
+            if name.endswith(AggregateCache.entry_suffix):
+                os.remove(self.folder + '/' + name)
+
+
+def evict_lru(paths, max_size):
+    #remove least recently modified files of paths until their size is at most max_size,
+    #files can be removed at the same time by other processes
+    files = list()
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime_ns, stat.st_size, path))
+    size = sum(file[1] for file in files)
+    for _, file_size, path in sorted(files):
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        size -= file_size
+
+def code_key(function):
+    #bytecode, constants and names of function and of functions of its module it calls, directly or
+    #through other ones, changing any of them (e.g. bin edges or labels) changes the key
+    key = list()
+    pending = [function]
+    seen = set()
+    while pending:
+        current = pending.pop()
+        if current in seen:
+            continue
+        seen.add(current)
+        codes = [current.__code__]
+        for code in codes:
+            #nested functions, lambdas and comprehensions have their own code objects
+            codes.extend(constant for constant in code.co_consts if isinstance(constant, types.CodeType))
+            key.append((current.__qualname__, code.co_code, code.co_names,
+                        tuple(constant for constant in code.co_consts if not isinstance(constant, types.CodeType))))
+            for name in code.co_names:
+                callee = current.__globals__.get(name)
+                if isinstance(callee, types.FunctionType) and callee.__module__ == current.__module__:
+                    pending.append(callee)
+    return key
+
+def rows_of(data):
+    #number of rows of DataFrame or of list from get_list, 0 for anything else
+    if isinstance(data, pd.DataFrame):
+        return len(data)
+    if isinstance(data, tuple) and len(data) == 2 and len(data[1]) > 0:
+        return len(data[1][0])
+    return 0
+
+def aggregate(data, function, *args, source = "dataframe", columns = None, **kwargs):
+    #function applied to data, if data is AggregateCache the result is looked up in it instead
+    if isinstance(data, AggregateCache):
+        return data.get(function, *args, source=source, columns=columns, **kwargs)
+    with instrument.stage("aggregate." + function.__name__) as stage:
+        stage.rows = rows_of(data)
+        return function(data, *args, **kwargs)
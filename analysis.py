@@ -7,7 +7,8 @@ import seaborn as sns
 import numpy as np
 import os
 import sys
-import io
+from download import DataDownloader
+from aggregates import AggregateCache, aggregate
 # muzete pridat libovolnou zakladni knihovnu ci knihovnu predstavenou na prednaskach
 # dalsi knihovny pak na dotaz
 
@@ -19,48 +20,101 @@ def get_dataframe(filename: str, verbose: bool = False) -> pd.DataFrame:
         return
     df = pd.read_pickle(filename)
 
-    
-    if verbose is True:
-        buf = io.StringIO()
-        df.info(buf=buf, memory_usage = "deep")
-        info = buf.getvalue()
-        print("orig_size=" + info.split('\n')[-2].split(': ')[1])
-    
-    # change types do reduce size, try int for all then float for all, then category for rest
-    for column in df:
-        try: 
-            df[column] = df[column].astype(np.int64)
-        except:
-            try:
-                df[column] = df[column].astype(np.float32)
-            except:
-                try:
-                    df[column] = df[column].astype("category")
-                except:
-                    pass
+    orig_size = df.memory_usage(deep=True).sum()
+
+    # change types to reduce size, each column is converted once
+    df = optimize_dtypes(df, verbose)
 
     df["date"] = pd.to_datetime(df["p2a"]).astype('datetime64[ns]')
     
     if verbose is True:
-        buf = io.StringIO()
-        df.info(buf=buf, memory_usage = "deep")
-        info = buf.getvalue()
-        print("new_size=" + info.split('\n')[-2].split(': ')[1])
+        print("orig_size=" + format_size(orig_size))
+        print("new_size=" + format_size(df.memory_usage(deep=True).sum()))
 
     return df
 
+def optimize_dtypes(df: pd.DataFrame, verbose: bool = False) -> pd.DataFrame:
+    # convert every column once to the narrowest type able to hold its values,
+    # numbers are narrowed by their range, strings become numbers if
+    # DataDownloader schema declares them numeric, category otherwise
+
+    converted = dict()
+    for column in df:
+        series = df[column]
+        if isinstance(series.dtype, pd.CategoricalDtype) or pd.api.types.is_datetime64_any_dtype(series) or pd.api.types.is_bool_dtype(series):
+            continue
+
+        if pd.api.types.is_numeric_dtype(series):
+            dtype = smallest_dtype(series.to_numpy())
+            if dtype != series.dtype:
+                converted[column] = series.astype(dtype)
+        else:
+            numbers = None
+            declared = DataDownloader.column_dtypes.get(column)
+            if declared is not None and np.dtype(declared).kind in "if":
+                try:
+                    numbers = pd.to_numeric(series)
+                except (ValueError, TypeError):
+                    pass
+            if numbers is not None:
+                converted[column] = numbers.astype(smallest_dtype(numbers.to_numpy()))
+            else:
+                converted[column] = series.astype("category")
+
+        if verbose is True and column in converted:
+            saved = series.memory_usage(index=False, deep=True) - converted[column].memory_usage(index=False, deep=True)
+            print("{}: {} -> {}, saved {}".format(column, series.dtype, converted[column].dtype, format_size(saved)))
+
+    return df.assign(**converted)
+
+def smallest_dtype(values: np.ndarray) -> np.dtype:
+    # narrowest type for numeric values, float32 if there are missing or fractional values
+
+    if values.size == 0:
+        return values.dtype
+    if values.dtype.kind == 'f' and (np.isnan(values).any() or (values != np.trunc(values)).any()):
+        return np.dtype(np.float32)
+
+    low, high = values.min(), values.max()
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        if np.iinfo(dtype).min <= low and high <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.float32)
+
+def format_size(size: int) -> str:
+    # size in bytes as in DataFrame.info
+    for unit in ("bytes", "KB", "MB", "GB"):
+        if abs(size) < 1024.0:
+            return "{:.1f} {}".format(size, unit) if unit != "bytes" else "{} {}".format(size, unit)
+        size /= 1024.0
+    return "{:.1f} TB".format(size)
+
 # Ukol 2: následky nehod v jednotlivých regionech
+def summarize_consequences(df: pd.DataFrame, by = "region") -> pd.DataFrame:
+    # sum of killed (p13a), seriously (p13b) and lightly (p13c) injured people
+    # and number of accidents (p1) for each group in one groupby pass,
+    # by is a column or list of columns, "year" and "month" are taken from date
+
+    if isinstance(by, str):
+        by = [by]
+
+    keys = list()
+    for key in by:
+        if key == "year" and "year" not in df:
+            keys.append(df["date"].dt.year.rename("year"))
+        elif key == "month" and "month" not in df:
+            keys.append(df["date"].dt.to_period("M").rename("month"))
+        else:
+            keys.append(df[key])
+
+    return df.groupby(keys, observed=True).agg(
+        p13a=("p13a", "sum"), p13b=("p13b", "sum"), p13c=("p13c", "sum"), p1=("p1", "size"))
+
 def plot_conseq(df: pd.DataFrame, fig_location: str = None,
                 show_figure: bool = False):
 
-    # melt to get values needed for plot 
-    df = df.melt(value_vars = ["date"], id_vars = ["region", "p13a", "p13b",  "p13c", "p1"])
-
-    region_df = pd.DataFrame()
-    
-    # sum data 
-    for region in df["region"].unique().tolist():
-        region_df[region] = df.loc[df["region"] == region].agg({"p13a" : "sum", "p13b" : "sum", "p13c" : "sum", "p1" :"size"})
+    # sum data, regions in columns, df can be AggregateCache holding the sums
+    region_df = aggregate(df, summarize_consequences, "region").T
 
     # plotting
     plt.style.use('fivethirtyeight')
@@ -94,88 +148,62 @@ def plot_conseq(df: pd.DataFrame, fig_location: str = None,
         plt.show()
     
 # Ukol3: příčina nehody a škoda
-def plot_damage(df: pd.DataFrame, fig_location: str = None,
-                show_figure: bool = False):
-    
-    #div by ten to get number in thousands instead of hudnreds
-    df["p53"] = (df["p53"]/10).astype(np.int64)
-
-    #melt to get values needed; label bins 
-    df = df.melt(value_vars = ["p1"], id_vars = ["p12", "p53", "region"])
-    df["cause"] = pd.cut(df["p12"], [np.NINF, 200,300,400,500,600,700], labels=["nezaviněná řidičem", 
-                                                                                "nepřiměřená rychlost jízdy", 
-                                                                                "nesprávné předjíždění", 
-                                                                                "nedání přednosti v jízdě", 
-                                                                                "nesprávný způsob jízdy", 
-                                                                                "technická závada vozidla"])
-
-    df["damage"] = pd.cut(df["p53"], [np.NINF, 49, 199, 499, 999, np.inf])
-    
-    df_agg = pd.DataFrame()
-
-    #get aggregated data for regions
-    for price in df["damage"].unique().tolist():
-        for cause in df["cause"].unique().tolist():
-            count = df.loc[df["damage"] == price].loc[df["cause"] == cause].loc[df["region"] == "PHA"].agg({"damage" : "count"})[0]
-            df_agg = df_agg.append({"damage" : price, "cause" : cause, "count" : count, "region" : "PHA"}, ignore_index=True)
-
-            count = df.loc[df["damage"] == price].loc[df["cause"] == cause].loc[df["region"] == "JHM"].agg({"damage" : "count"})[0]
-            df_agg = df_agg.append({"damage" : price, "cause" : cause, "count" : count, "region" : "JHM"}, ignore_index=True)
-
-            count = df.loc[df["damage"] == price].loc[df["cause"] == cause].loc[df["region"] == "OLK"].agg({"damage" : "count"})[0]
-            df_agg = df_agg.append({"damage" : price, "cause" : cause, "count" : count, "region" : "OLK"}, ignore_index=True)
-
-            count = df.loc[df["damage"] == price].loc[df["cause"] == cause].loc[df["region"] == "LBK"].agg({"damage" : "count"})[0]
-            df_agg = df_agg.append({"damage" : price, "cause" : cause, "count" : count, "region" : "LBK"}, ignore_index=True)
-    
+def damage_counts(df: pd.DataFrame, regions: list) -> pd.DataFrame:
+    # count accidents for every damage bin, cause and region in one groupby,
+    # missing combinations are zero
+
+    #div by ten to get number in thousands instead of hudnreds; label bins 
+    cause = pd.cut(df["p12"], [-np.inf, 200,300,400,500,600,700], labels=["nezaviněná řidičem", 
+                                                                        "nepřiměřená rychlost jízdy", 
+                                                                        "nesprávné předjíždění", 
+                                                                        "nedání přednosti v jízdě", 
+                                                                        "nesprávný způsob jízdy", 
+                                                                        "technická závada vozidla"])
+    damage = pd.cut(np.trunc(df["p53"] / 10), [-np.inf, 49, 199, 499, 999, np.inf])
+    region = pd.Categorical(df["region"], categories=regions)
+
+    df_agg = pd.DataFrame({"damage" : damage, "cause" : cause, "region" : region}).groupby(
+        ["damage", "cause", "region"], observed=False).size().rename("count").reset_index()
     df_agg["count"] = df_agg["count"].astype(np.int64)
+    return df_agg
 
+def plot_damage(df: pd.DataFrame, fig_location: str = None,
+                show_figure: bool = False, regions: list = None):
     
-    #plotting using seaborn
-    fig, ax = plt.subplots(nrows = 2, ncols=3, figsize=(11,6), constrained_layout = True)
+    #get aggregated data for regions, from cache if df is AggregateCache
+    if regions is None:
+        regions = ["PHA", "JHM", "OLK", "LBK"]
+    df_agg = aggregate(df, damage_counts, regions)
+
+    #plotting using seaborn, regions fill columns of two rows, last column is for legend
+    ncols = (len(regions) + 1) // 2 + 1
+    fig, ax = plt.subplots(nrows = 2, ncols=ncols, figsize=(11 / 3 * ncols,6), constrained_layout = True, squeeze = False)
     
     sns.set_theme(style = "whitegrid")
-    sns.barplot(
-        data = df_agg.loc[df_agg["region"] == "PHA"].sort_values(by = "damage"),
-        x = "damage", y = "count" , hue="cause", ci = "sd", palette="dark", alpha = .6,
-        ax=ax[0][0]
-    ).set_title("PHA", fontsize = 11)
-
-    sns.barplot(
-        data = df_agg.loc[df_agg["region"] == "JHM"].sort_values(by = "damage"),
-        x = "damage", y = "count" , hue="cause", ci = "sd", palette="dark", alpha = .6,
-        ax=ax[1][0]
-    ).set_title("JHM", fontsize = 11)
-
-    sns.barplot(
-        data = df_agg.loc[df_agg["region"] == "OLK"].sort_values(by = "damage"),
-        x = "damage", y = "count" , hue="cause", ci = "sd", palette="dark", alpha = .6,
-        ax=ax[0][1]
-    ).set_title("OLK", fontsize = 11)
-
-    sns.barplot(
-        data = df_agg.loc[df_agg["region"] == "LBK"].sort_values(by = "damage"),
-        x = "damage", y = "count" , hue="cause", ci = "sd", palette="dark", alpha = .6,
-        ax=ax[1][1]
-    ).set_title("LBK", fontsize = 11)
+    for i, region in enumerate(regions):
+        sns.barplot(
+            data = df_agg.loc[df_agg["region"] == region].sort_values(by = "damage"),
+            x = "damage", y = "count" , hue="cause", ci = "sd", palette="dark", alpha = .6,
+            ax=ax[i % 2][i // 2]
+        ).set_title(region, fontsize = 11)
 
     #formatting plot
-    for col in ax:
-        for row in col:
-                row.tick_params(axis='x', labelsize = 8)
-                row.tick_params(axis='y', labelsize = 8)
-                row.set_yscale("log")
-                row.legend().remove()
-                row.set(xlabel = "Škoda [sto Kč]", ylabel = "Počet")
-                row.set_xticklabels(["< 50", "50 - 200", "200 - 500", "500 - 1000", "> 1000"])
-
-    handles, labels = ax[1][1].get_legend_handles_labels()
-
-    ax[-1, -1].axis('off')
-    ax[-2, -1].axis('off')
+    for i, region in enumerate(regions):
+        row = ax[i % 2][i // 2]
+        row.tick_params(axis='x', labelsize = 8)
+        row.tick_params(axis='y', labelsize = 8)
+        row.set_yscale("log")
+        row.legend().remove()
+        row.set(xlabel = "Škoda [sto Kč]", ylabel = "Počet")
+        row.set_xticklabels(["< 50", "50 - 200", "200 - 500", "500 - 1000", "> 1000"])
+
+    handles, labels = ax[(len(regions) - 1) % 2][(len(regions) - 1) // 2].get_legend_handles_labels()
+
+    #axes without region, legend saved in place of a subplot to look cleaner
+    for i in range(len(regions), 2 * ncols):
+        ax[i % 2][i // 2].axis('off')
     
-    #legend saved in place of a subplot to look cleaner
-    fig.legend(handles, labels, loc = "center left", bbox_to_anchor=(0.7, 0.5))
+    fig.legend(handles, labels, loc = "center left", bbox_to_anchor=(1 - 0.9 / ncols, 0.5))
 
 
     if fig_location is not None:
@@ -186,36 +214,36 @@ def plot_damage(df: pd.DataFrame, fig_location: str = None,
 
 # Ukol 4: povrch vozovky
 
+def surface_counts(df: pd.DataFrame, regions: list, years: range) -> pd.DataFrame:
+    # count accidents in every month of given years for each surface state
+    # (p16 0-9) and region in one pass, missing combinations are zero
+    
+    all_months = np.arange(np.datetime64(str(years[0]), "M"), np.datetime64(str(years[-1] + 1), "M"))
+    states = np.arange(0, 10)
+
+    # position of each accident in grid of month, surface state and region
+    month = (df["date"].to_numpy().astype("datetime64[M]") - all_months[0]).astype(np.int64)
+    state = pd.to_numeric(df["p16"]).to_numpy()
+    region = pd.Categorical(df["region"], categories=regions).codes
+    valid = (month >= 0) & (month < len(all_months)) & np.isin(state, states) & (region >= 0)
+
+    cell = (month[valid] * len(states) + state[valid].astype(np.int64)) * len(regions) + region[valid]
+    counts = np.bincount(cell, minlength=len(all_months) * len(states) * len(regions))
+
+    df_agg = pd.DataFrame({
+        "date" : np.repeat(all_months, len(states) * len(regions)).astype("datetime64[ns]"),
+        "p16" : np.tile(np.repeat(states, len(regions)), len(all_months)),
+        "count" : counts.astype(np.int64),
+        "region" : np.tile(regions, len(all_months) * len(states))})
+    df_agg["p16"] = df_agg["p16"].astype("category")
+    return df_agg
+
 def plot_surface(df: pd.DataFrame, fig_location: str = None,
                  show_figure: bool = False):
                  
-    #table = df.pivot_table(values="p1", index = ["p16", "date"], aggfunc="count")
-    
-    #getting required columns
-    df = df.melt(value_vars = ["p1"], id_vars = ["p16", "region", "date"])
-    df_agg = pd.DataFrame()
-    
-    #aggregating data - very suboptimal time efficiency
-    for year in range(2016, 2021):
-        for month in range(1,13):
-            for acc in range (0,10):
-                count = df.loc[df["date"].dt.month == month].loc[df["date"].dt.year == year].loc[df["p16"] == acc].loc[df["region"] == "KVK"].agg({"p16" : "count"})[0]
-                df_agg = df_agg.append({"date" : str(year) + "-" + str(month), "p16" : acc, "count" : count, "region" : "KVK"}, ignore_index=True)
-                
-                count = df.loc[df["date"].dt.month == month].loc[df["date"].dt.year == year].loc[df["p16"] == acc].loc[df["region"] == "PHA"].agg({"p16" : "count"})[0]
-                df_agg = df_agg.append({"date" : str(year) + "-" + str(month), "p16" : acc, "count" : count, "region" : "PHA"}, ignore_index=True)
-                
-                count = df.loc[df["date"].dt.month == month].loc[df["date"].dt.year == year].loc[df["p16"] == acc].loc[df["region"] == "JHM"].agg({"p16" : "count"})[0]
-                df_agg = df_agg.append({"date" : str(year) + "-" + str(month), "p16" : acc, "count" : count, "region" : "JHM"}, ignore_index=True)
-                
-                count = df.loc[df["date"].dt.month == month].loc[df["date"].dt.year == year].loc[df["p16"] == acc].loc[df["region"] == "OLK"].agg({"p16" : "count"})[0]
-                df_agg = df_agg.append({"date" : str(year) + "-" + str(month), "p16" : acc, "count" : count, "region" : "OLK"}, ignore_index=True)
-    
-    
-    #changing typos
-    df_agg["date"] = df_agg["date"].astype('datetime64[M]')
-    df_agg["count"] = df_agg["count"].astype(np.int64)
-    df_agg["p16"] = df_agg["p16"].astype("category")
+    #aggregating data - counts of accidents per month, surface state and region,
+    #from cache if df is AggregateCache
+    df_agg = aggregate(df, surface_counts, ["KVK", "PHA", "JHM", "OLK"], range(2016, 2021))
 
     #plotting
     fig, ax = plt.subplots(nrows = 2, ncols=3, figsize=(11,6), constrained_layout = True)
@@ -272,7 +300,10 @@ if __name__ == "__main__":
     # zde je ukazka pouziti, tuto cast muzete modifikovat podle libosti
     # skript nebude pri testovani pousten primo, ale budou volany konkreni
     # funkce.
-    df = get_dataframe("accidents.pkl.gz", verbose=True)
+    # data are loaded straight from DataDownloader with the right types,
+    # get_dataframe is needed only for an already saved accidents.pkl.gz,
+    # with AggregateCache data are loaded only if they changed since the last run
+    df = AggregateCache()
     #plot_conseq(df, fig_location="01_nasledky.png", show_figure=True)
     plot_damage(df, None, True)
     #plot_surface(df, "03_stav.png", True)
@@ -0,0 +1,726 @@
+from download import DataDownloader
+import analysis
+import get_stat
+from aggregates import AggregateCache
+import pandas as pd
+import numpy as np
+import zipfile as zf
+import os, sys, csv, io, json, time, tempfile, argparse, tracemalloc, resource, shutil, threading, filecmp, subprocess
+import http.server, email.utils
+
+#generating synthetic archives with the same layout as the ones on the remote site
+
+def make_row(rng, region_code, year, i):
+    #create one csv row with values of the same shape as real data
+    row = list()
+    for key in DataDownloader.column_types:
+        if key == "p99":
+            continue
+        if key == "p1":
+            row.append("{:02d}{:02d}{:08d}".format(int(region_code), year % 100, i))
+        elif key == "p2a":
+            row.append("{}-{:02d}-{:02d}".format(year, rng.integers(1, 13), rng.integers(1, 29)))
+        elif key == "p2b":
+            row.append("{:02d}{:02d}".format(rng.integers(0, 24), rng.integers(0, 60)))
+        elif key == "p47":
+            row.append("XX" if rng.random() < 0.05 else str(rng.integers(1970, year + 1)))
+        elif key in ("d", "e"):
+            #S-JTSK coordinates inside Czechia
+            low, high = (-900000, -430000) if key == "d" else (-1230000, -935000)
+            row.append("" if rng.random() < 0.02 else "{:.2f}".format(rng.uniform(low, high)).replace('.', ','))
+        elif key in DataDownloader.decimal_comma_columns:
+            row.append("" if rng.random() < 0.02 else "{:.2f}".format(rng.uniform(-900000, -400000)).replace('.', ','))
+        elif key in ("h", "i"):
+            row.append("Ulice {}".format(rng.integers(0, 500)))
+        elif key in ("k", "t"):
+            row.append("Obec {}".format(rng.integers(0, 100)))
+        elif key in ("l", "p", "q"):
+            row.append("{}".format(rng.integers(0, 50)))
+        elif key == "p14" or key == "p53":
+            row.append(str(rng.integers(0, 5000)))
+        else:
+            row.append("" if rng.random() < 0.01 else str(rng.integers(0, 10)))
+    return row
+
+def make_archive(path, year, rows, seed=0):
+    #create zip with csv files 00.csv to 19.csv like the real ones, including the ones of no region
+    rng = np.random.default_rng(seed + year)
+    with zf.ZipFile(path, 'w', compression=zf.ZIP_DEFLATED) as archive:
+        for csv_name in ["{:02d}.csv".format(number) for number in range(20)]:
+            buf = io.StringIO()
+            writer = csv.writer(buf, delimiter=';', quoting=csv.QUOTE_ALL, lineterminator='\r\n')
+            for i in range(rows):
+                writer.writerow(make_row(rng, csv_name[:2], year, i))
+            archive.writestr(csv_name, buf.getvalue().encode("windows-1250"))
+
+def make_folder(folder, years, rows):
+    #create archive for each year in folder, named as on the remote site where 2020 has monthly snapshots
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for year in years:
+        name = "datagis-12-{}.zip" if year >= 2020 else "datagis{}.zip"
+        make_archive(folder + '/' + name.format(year), year, rows)
+
+#local stand-in for the remote site, serves archives of a folder with the same index page layout
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    folder = None
+
+    #(path, Range, If-Range, status) of every response
+    log = None
+
+    def send_response(self, code, message=None):
+        self.log.append((self.path, self.headers.get('Range'), self.headers.get('If-Range'), code))
+        super().send_response(code, message)
+
+    def do_GET(self):
+        if self.path == '/':
+            links = ''.join('<tr><td>{0}</td><td><a href="data/{0}">ZIP</a></td></tr>'.format(name)
+                            for name in sorted(os.listdir(self.folder)) if name.endswith(".zip"))
+            body = "<html><body><table>{}</table></body></html>".format(links).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        path = self.folder + '/' + self.path.split('/')[-1]
+        if not self.path.startswith('/data/') or not os.path.exists(path):
+            self.send_error(404)
+            return
+
+        stat = os.stat(path)
+        etag = '"{:x}-{:x}"'.format(stat.st_size, int(stat.st_mtime))
+        last_modified = email.utils.formatdate(int(stat.st_mtime), usegmt=True)
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if self.headers.get('Range') and self.headers.get('If-Range') in (None, etag, last_modified):
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            if start >= stat.st_size:
+                self.send_error(416)
+                return
+
+        self.send_response(206 if start else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', last_modified)
+        self.send_header('Content-Length', str(stat.st_size - start))
+        if start:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, stat.st_size - 1, stat.st_size))
+        self.end_headers()
+        with open(path, 'rb') as f:
+            f.seek(start)
+            shutil.copyfileobj(f, self.wfile)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_folder(folder):
+    #start stand-in server in background thread, returns server and its url
+    handler = type("Handler", (StandInHandler,), {"folder" : folder, "log" : list()})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:{}/".format(server.server_address[1])
+
+#original per cell parser, kept as reference for comparison
+
+def legacy_initialize_nd_list(nd_list, len):
+    for key in DataDownloader.column_types:
+        if key == "p2a":
+            nd_list.append(np.zeros([len], dtype = "datetime64[D]"))
+        elif key == "h" or key == "i":
+            nd_list.append(np.zeros([len], dtype = "U64"))
+        elif key == "k" or key == "t":
+            nd_list.append(np.zeros([len], dtype = "U32"))
+        elif key == "l" or key == "p99":
+            nd_list.append(np.zeros([len], dtype = "U8"))
+        elif key == "p" or key == "q":
+            nd_list.append(np.zeros([len], dtype = "U16"))
+        else:
+            nd_list.append(np.zeros([len]))
+
+def legacy_parse_csv(nd_list, csv_list, region):
+    for i, row in enumerate(csv_list):
+        for ((j, cell), ct) in zip(enumerate(row), DataDownloader.column_types):
+            if ct == "p2a":
+                nd_list[j][i] = np.datetime64(cell)
+            elif ct == "p47" and cell.upper() =="XX":
+                nd_list[j][i] = -1
+            elif ',' in cell and (ct == "a" or ct == "b" or ct == "d" or ct =="e" or ct == "f" or ct =="g" or ct == "o"):
+                nd_list[j][i] = float(cell.replace(',','.',1))
+            elif cell == '':
+                nd_list[j][i] = np.nan
+            else:
+                try:
+                    nd_list[j][i] = cell
+                except:
+                    try:
+                        nd_list[j][i] = float.fromhex(cell)
+                    except:
+                        nd_list[j][i] = np.nan
+        nd_list[-1][i] = region
+
+def legacy_parse_region_data(folder, region):
+    parsed = list()
+    for file in sorted(os.listdir(folder)):
+        if zf.is_zipfile(folder + '/' + file):
+            with zf.ZipFile(folder + '/' + file).open(DataDownloader.region_match[region], 'r') as csvfile:
+                csv_list = list(csv.reader(io.TextIOWrapper(csvfile, encoding="windows-1250"), delimiter=';'))
+            nd_list = list()
+            legacy_initialize_nd_list(nd_list, len(csv_list))
+            legacy_parse_csv(nd_list, csv_list, region)
+            if not parsed:
+                parsed = nd_list
+            else:
+                for i, data in enumerate(nd_list):
+                    parsed[i] = np.append(parsed[i], data, axis=0)
+    return parsed
+
+def legacy_merge(chunks):
+    #merge lists of ndarrays by appending them one after another
+    merged = list()
+    legacy_initialize_nd_list(merged, 0)
+    for chunk in chunks:
+        for i, data in enumerate(chunk):
+            merged[i] = np.append(merged[i], data, axis=0)
+    return merged
+
+def legacy_surface_counts(df):
+    #surface counts with a filter over the whole frame for every month, state and region
+    rows = list()
+    for year in range(2016, 2021):
+        for month in range(1,13):
+            for acc in range (0,10):
+                for region in ("KVK", "PHA", "JHM", "OLK"):
+                    count = df.loc[df["date"].dt.month == month].loc[df["date"].dt.year == year].loc[df["p16"] == acc].loc[df["region"] == region].agg({"p16" : "count"}).iloc[0]
+                    rows.append({"date" : str(year) + "-" + str(month), "p16" : acc, "count" : count, "region" : region})
+    df_agg = pd.DataFrame(rows)
+    df_agg["date"] = pd.to_datetime(df_agg["date"], format="%Y-%m").astype("datetime64[ns]")
+    df_agg["count"] = df_agg["count"].astype(np.int64)
+    df_agg["p16"] = df_agg["p16"].astype("category")
+    return df_agg
+
+def legacy_damage_counts(df):
+    #damage counts with a filter over the whole frame for every damage bin, cause and region
+    df = df.melt(value_vars = ["p1"], id_vars = ["p12", "p53", "region"])
+    df["cause"] = pd.cut(df["p12"], [-np.inf, 200,300,400,500,600,700], labels=["nezaviněná řidičem",
+                                                                                "nepřiměřená rychlost jízdy",
+                                                                                "nesprávné předjíždění",
+                                                                                "nedání přednosti v jízdě",
+                                                                                "nesprávný způsob jízdy",
+                                                                                "technická závada vozidla"])
+    df["damage"] = pd.cut(np.trunc(df["p53"] / 10), [-np.inf, 49, 199, 499, 999, np.inf])
+    rows = list()
+    for price in df["damage"].unique().tolist():
+        for cause in df["cause"].unique().tolist():
+            for region in ("PHA", "JHM", "OLK", "LBK"):
+                count = df.loc[df["damage"] == price].loc[df["cause"] == cause].loc[df["region"] == region].agg({"damage" : "count"}).iloc[0]
+                rows.append({"damage" : price, "cause" : cause, "count" : count, "region" : region})
+    return pd.DataFrame(rows)
+
+def legacy_consequences(df):
+    #consequence sums with melt and a filter for every region
+    df = df.melt(value_vars = ["date"], id_vars = ["region", "p13a", "p13b",  "p13c", "p1"])
+    region_df = pd.DataFrame()
+    for region in df["region"].unique().tolist():
+        region_df[region] = df.loc[df["region"] == region].agg({"p13a" : "sum", "p13b" : "sum", "p13c" : "sum", "p1" :"size"})
+    return region_df
+
+def legacy_stat_counts(data_source):
+    #accidents per region and year counted in a python loop over rows
+    regions = dict()
+    dates = data_source[1][data_source[0].index("p2a")]
+    region_codes = data_source[1][data_source[0].index("p99")].decode()
+    for date, region in zip(dates, region_codes):
+        year = str(date.astype(object).year)
+        regions.setdefault(region, dict())
+        regions[region][year] = regions[region].get(year, 0) + 1
+    return regions
+
+#benchmarks
+
+def timed(function, *args, **kwargs):
+    #return result of function and time it took in seconds
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+def traced(function, *args, **kwargs):
+    #return result of function, time it took and peak of memory allocated during the call in MiB
+    tracemalloc.start()
+    result, seconds = timed(function, *args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak / 2**20
+
+def max_rss():
+    #peak resident set size of the process in MiB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+def offline_downloader(folder, **kwargs):
+    #downloader that only uses archives already present in folder
+    return DataDownloader(folder=folder, offline=True, **kwargs)
+
+def integer_as_float(column):
+    #integer column as float64, minimum of the type marks missing value
+    if column.dtype.kind != 'i':
+        return column
+    values = column.astype(np.float64)
+    values[column == np.iinfo(column.dtype).min] = np.nan
+    return values
+
+def remove_cache(folder, cache_filename):
+    #remove cache files of all regions with their lists of archives
+    for region in DataDownloader.region_match:
+        path = folder + '/' + cache_filename.format(region)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        if os.path.exists(path + '.archives.json'):
+            os.remove(path + '.archives.json')
+
+def same_columns(first, second):
+    #compare two lists of ndarrays, nan values are equal, encoded strings are compared decoded
+    for a, b in zip(first, second):
+        a = a.decode() if hasattr(a, "decode") else a
+        b = b.decode() if hasattr(b, "decode") else b
+        a = integer_as_float(a)
+        b = integer_as_float(b)
+        if a.dtype.kind == 'f':
+            if not np.array_equal(a, b, equal_nan=True):
+                return False
+        elif not np.array_equal(a, b):
+            return False
+    return len(first) == len(second)
+
+def bench_parse(folder, regions):
+    #compare per cell parser with column parser
+    downloader = DataDownloader(folder=folder)
+    print("region  rows  legacy[s]  column[s]  speedup  equal")
+    for region in regions:
+        legacy, legacy_time = timed(legacy_parse_region_data, folder, region)
+        parsed, parse_time = timed(downloader.parse_region_data, region)
+        print("{:6}  {:4}  {:9.3f}  {:9.3f}  {:6.1f}x  {}".format(
+            region, parsed[1][0].size, legacy_time, parse_time,
+            legacy_time / parse_time, same_columns(legacy, parsed[1])))
+
+def bench_merge(folder, regions):
+    #compare repeated np.append with single concatenation, on archive and on region level
+    downloader = DataDownloader(folder=folder)
+    chunks = list()
+    for file in sorted(os.listdir(folder)):
+        if file.endswith('.zip') and zf.is_zipfile(folder + '/' + file):
+            for region in DataDownloader.region_match:
+                with zf.ZipFile(folder + '/' + file).open(DataDownloader.region_match[region], 'r') as csvfile:
+                    chunks.append(downloader.parse_csv(csvfile, region))
+
+    print("merge        chunks  time[s]  peak[MiB]  equal")
+    fixed_chunks = [[column.decode() if hasattr(column, "decode") else integer_as_float(column) for column in chunk] for chunk in chunks]
+    appended, append_time, append_peak = traced(legacy_merge, fixed_chunks)
+    merged, merge_time, merge_peak = traced(downloader.merge_nd_lists, chunks)
+    print("np.append    {:6}  {:7.3f}  {:9.1f}".format(len(chunks), append_time, append_peak))
+    print("concatenate  {:6}  {:7.3f}  {:9.1f}  {}".format(len(chunks), merge_time, merge_peak, same_columns(appended, merged)))
+
+def bench_load(folder, regions):
+    #full load of all regions, cold from archives and warm from cache files
+    print("load  regions  rows  time[s]  peak[MiB]  maxrss[MiB]")
+    cache_filename = "bench_{}.pkl.gz"
+    for name in ("cold", "warm"):
+        downloader = offline_downloader(folder, cache_filename=cache_filename)
+        data, seconds, peak = traced(downloader.get_list)
+        print("{:4}  {:7}  {:4}  {:7.3f}  {:9.1f}  {:11.1f}".format(
+            name, len(DataDownloader.region_match), data[1][0].size, seconds, peak, max_rss()))
+    remove_cache(folder, cache_filename)
+
+def bench_workers(folder, regions):
+    #cold load of all regions with growing number of worker processes
+    print("workers  time[s]  speedup  equal")
+    cache_filename = "bench_workers_{}.pkl.gz"
+    first = None
+    for workers in sorted({1, 2, 4, os.cpu_count() or 1}):
+        data, seconds = timed(offline_downloader(folder, cache_filename=cache_filename).get_list, workers=workers)
+        if first is None:
+            first = (data, seconds)
+        print("{:7}  {:7.3f}  {:6.1f}x  {}".format(workers, seconds, first[1] / seconds, same_columns(first[0][1], data[1])))
+        remove_cache(folder, cache_filename)
+
+def bench_download(folder, regions):
+    #download from stand-in server: full, unchanged (conditional requests) and resumed after truncation
+    server, url = serve_folder(folder)
+    print("download   time[s]  equal  requests")
+    with tempfile.TemporaryDirectory() as target:
+        downloader = DataDownloader(url=url, folder=target)
+
+        def equal():
+            return all(os.path.exists(target + '/' + name) and filecmp.cmp(folder + '/' + name, target + '/' + name, shallow=False) for name in archives)
+
+        def responses(run):
+            #status codes of archive requests made by run, with Range and If-Range for 206
+            log = server.RequestHandlerClass.log
+            del log[:]
+            _, seconds = timed(run)
+            codes = [str(code) + ("" if code != 206 or not (ranged and validator) else "+range")
+                     for path, ranged, validator, code in log if path.endswith(".zip")]
+            return seconds, " ".join("{}x{}".format(codes.count(code), code) for code in sorted(set(codes)))
+
+        seconds, codes = responses(downloader.download_data)
+        archives = [name for name in sorted(os.listdir(target)) if name.endswith(".zip")]
+        print("full       {:7.3f}  {:5}  {}".format(seconds, str(equal()), codes))
+        seconds, codes = responses(downloader.download_data)
+        print("unchanged  {:7.3f}  {:5}  {}".format(seconds, str(equal()), codes))
+
+        #keep first half of each archive as unfinished download, with validators saved as by an interrupted transfer
+        state = downloader.load_download_state()
+        for name in archives:
+            os.replace(target + '/' + name, target + '/' + name + '.part')
+            with open(target + '/' + name + '.part', 'r+b') as f:
+                f.truncate(os.path.getsize(folder + '/' + name) // 2)
+            state[name]["partial"] = {"etag" : state[name]["etag"], "last_modified" : state[name]["last_modified"]}
+        downloader.save_download_state(state)
+        seconds, codes = responses(downloader.download_data)
+        print("resumed    {:7.3f}  {:5}  {}".format(seconds, str(equal()), codes))
+    server.shutdown()
+
+def bench_cache(folder, regions):
+    #save and load all regions with gzip pickle and columnar cache, then only two columns from columnar cache
+    parsed = DataDownloader(folder=folder).parse_regions(list(DataDownloader.region_match))
+    print("cache     save[s]  load[s]  size[MiB]  equal")
+    for name, cache_filename in (("pickle", "bench_{}.pkl.gz"), ("columns", "bench_{}")):
+        downloader = DataDownloader(folder=folder, cache_filename=cache_filename)
+        _, save_time = timed(lambda: [downloader.save_cache(parsed[region], region) for region in parsed])
+        loaded, load_time = timed(lambda: {region : downloader.load_cache(region) for region in parsed})
+        size = 0
+        for region in parsed:
+            path = folder + '/' + cache_filename.format(region)
+            size += sum(os.path.getsize(path + '/' + file) for file in os.listdir(path)) if os.path.isdir(path) else os.path.getsize(path)
+        equal = all(same_columns(parsed[region][1], loaded[region][1]) for region in parsed)
+        print("{:8}  {:7.3f}  {:7.3f}  {:9.1f}  {}".format(name, save_time, load_time, size / 2**20, equal))
+
+    _, load_time = timed(lambda: [np.array(column) for region in parsed for column in downloader.load_columns(region, ["p2a", "p13a"])[1]])
+    print("{:8}  {:>7}  {:7.3f}".format("2 cols", "", load_time))
+
+    remove_cache(folder, "bench_{}.pkl.gz")
+    remove_cache(folder, "bench_{}")
+
+def bench_select(folder, regions):
+    #warm load of all regions from columnar cache, all columns against projection and filters
+    cache_filename = "bench_select_{}"
+    offline_downloader(folder, cache_filename=cache_filename).get_list()
+    print("select     rows  time[s]  peak[MiB]")
+    for name, kwargs in (("all", dict()),
+                         ("2 cols", dict(columns=["p2a", "p99"])),
+                         ("filtered", dict(columns=["p2a", "p99"], filters={"p2a" : slice("2017-01-01", "2018-01-01"), "p16" : 1}))):
+        data, seconds, peak = traced(offline_downloader(folder, cache_filename=cache_filename).get_list, **kwargs)
+        print("{:8}  {:6}  {:7.3f}  {:9.1f}".format(name, data[1][0].size, seconds, peak))
+    remove_cache(folder, cache_filename)
+
+def bench_memory(folder, regions):
+    #memory of parsed columns, as originally stored (float64 and fixed width strings) and with current types
+    parsed = DataDownloader(folder=folder).parse_regions(list(DataDownloader.region_match))
+    print("region  strings[MiB]  encoded[MiB]  numbers[MiB]  narrowed[MiB]  saved")
+    for region in parsed:
+        strings = encoded = numbers = narrowed = 0
+        for key, column in zip(*parsed[region]):
+            if hasattr(column, "categories"):
+                strings += np.array(column.decode(), dtype=DataDownloader.column_dtypes[key]).nbytes
+                encoded += column.nbytes + column.categories.nbytes
+            elif column.dtype.kind != 'M':
+                numbers += column.size * 8
+                narrowed += column.nbytes
+        print("{:6}  {:12.2f}  {:12.2f}  {:12.2f}  {:13.2f}  {:4.0f}%".format(
+            region, strings / 2**20, encoded / 2**20, numbers / 2**20, narrowed / 2**20,
+            100 * (1 - (encoded + narrowed) / (strings + numbers))))
+
+def bench_update(folder, regions):
+    #new monthly snapshot in folder, incremental update of caches against full rebuild
+    cache_filename = "bench_update_{}"
+    offline_downloader(folder, cache_filename=cache_filename).get_list()
+    snapshot = folder + '/' + "datagis-01-2099.zip"
+    make_archive(snapshot, 2099, 100)
+
+    print("refresh  time[s]  equal")
+    updated, update_time = timed(offline_downloader(folder, cache_filename=cache_filename).get_list, update=True)
+    remove_cache(folder, cache_filename)
+    rebuilt, rebuild_time = timed(offline_downloader(folder, cache_filename=cache_filename).get_list)
+    print("update   {:7.3f}  {}".format(update_time, same_columns(updated[1], rebuilt[1])))
+    print("rebuild  {:7.3f}".format(rebuild_time))
+
+    os.remove(snapshot)
+    remove_cache(folder, cache_filename)
+
+def bench_sidefiles(folder, regions):
+    #grid index saved next to cache of one region (.npz is a zip file too), other regions are then loaded from archives
+    cache_filename = "bench_sidefiles_{}"
+    downloader = offline_downloader(folder, cache_filename=cache_filename)
+    try:
+        import geo
+        geo.GridIndex.for_region(regions[0], downloader)
+    except ImportError:
+        #geo needs geopandas, save side files of the same names as geo does
+        for suffix in ("grid", "epsg3857", "pyramid"):
+            np.savez(folder + '/' + cache_filename.format(regions[0]) + '.' + suffix + '.npz', x=np.zeros(1))
+    side_files = [name for name in os.listdir(folder) if name.endswith('.npz')]
+
+    print("side files  archives  get_list  update  batches")
+    reference = offline_downloader(folder).parse_region_data(regions[1])[1]
+    loaded = offline_downloader(folder, cache_filename=cache_filename).get_list([regions[1]])[1]
+    remove_cache(folder, cache_filename)
+    offline_downloader(folder, cache_filename=cache_filename).update_cache([regions[1]])
+    updated = offline_downloader(folder, cache_filename=cache_filename).get_list([regions[1]])[1]
+    remove_cache(folder, cache_filename)
+    batches = list(offline_downloader(folder, cache_filename=cache_filename).iter_batches([regions[1]], columns=["p1"]))
+    print("{:10}  {:8}  {:8}  {:6}  {:7}".format(
+        len(side_files), len(offline_downloader(folder).archive_files()), str(same_columns(loaded, reference)),
+        str(same_columns(updated, reference)), str(sum(len(batch[1][0]) for batch in batches) == len(reference[0]))))
+
+    for name in side_files:
+        os.remove(folder + '/' + name)
+    remove_cache(folder, cache_filename)
+
+def bench_batches(folder, regions):
+    #count accidents per region and year from batches against whole dataset, from archives and from columnar cache
+    cache_filename = "bench_batches_{}"
+
+    def count_batches(downloader):
+        counts = dict()
+        for batch in downloader.iter_batches(batch_size=1000, columns=["p2a", "p99"]):
+            years = batch[1][0].astype("datetime64[Y]").astype(int) + 1970
+            for region, year in zip(batch[1][1].decode(), years):
+                counts[(region, year)] = counts.get((region, year), 0) + 1
+        return counts
+
+    def count_list(downloader):
+        data = downloader.get_list(columns=["p2a", "p99"])
+        years = data[1][0].astype("datetime64[Y]").astype(int) + 1970
+        counts = dict()
+        for region, year in zip(data[1][1].decode(), years):
+            counts[(region, year)] = counts.get((region, year), 0) + 1
+        return counts
+
+    print("source    get_list[s]  peak[MiB]  batches[s]  peak[MiB]  equal")
+    for name in ("archives", "cache"):
+        batched, batch_time, batch_peak = traced(count_batches, offline_downloader(folder, cache_filename=cache_filename))
+        counted, list_time, list_peak = traced(count_list, offline_downloader(folder, cache_filename=cache_filename))
+        print("{:8}  {:11.3f}  {:9.1f}  {:10.3f}  {:9.1f}  {}".format(name, list_time, list_peak, batch_time, batch_peak, batched == counted))
+    remove_cache(folder, cache_filename)
+
+def bench_surface(folder, regions):
+    #monthly surface state counts, filters for every combination against single pass
+    df = offline_downloader(folder).to_dataframe()
+    legacy, legacy_time = timed(legacy_surface_counts, df)
+    counts, counts_time = timed(analysis.surface_counts, df, ["KVK", "PHA", "JHM", "OLK"], range(2016, 2021))
+    equal = legacy.reset_index(drop=True).astype({"p16" : int}).equals(counts.astype({"p16" : int}))
+    print("surface  legacy[s]  grouped[s]  speedup  equal")
+    print("{:7}  {:9.3f}  {:10.4f}  {:6.0f}x  {}".format(len(df), legacy_time, counts_time, legacy_time / counts_time, equal))
+
+def bench_damage(folder, regions):
+    #cause and damage counts, filters for every combination against single groupby, then for all regions
+    df = offline_downloader(folder).to_dataframe()
+    legacy, legacy_time = timed(legacy_damage_counts, df)
+    counts, counts_time = timed(analysis.damage_counts, df, ["PHA", "JHM", "OLK", "LBK"])
+    merged = legacy.dropna().merge(counts, on=["damage", "cause", "region"], how="left", suffixes=("", "_grouped"))
+    equal = bool((merged["count"] == merged["count_grouped"]).all())
+    _, country_time = timed(analysis.damage_counts, df, list(DataDownloader.region_match))
+    print("damage   legacy[s]  grouped[s]  country[s]  equal")
+    print("{:7}  {:9.3f}  {:10.4f}  {:10.4f}  {}".format(len(df), legacy_time, counts_time, country_time, equal))
+
+def bench_conseq(folder, regions):
+    #consequences per region, melt and filters against single groupby, then per region and month
+    df = offline_downloader(folder).to_dataframe()
+    legacy, legacy_time = timed(legacy_consequences, df)
+    summary, summary_time = timed(analysis.summarize_consequences, df, "region")
+    _, monthly_time = timed(analysis.summarize_consequences, df, ["region", "month"])
+    equal = np.allclose(legacy[summary.index].to_numpy(dtype=float), summary.T.to_numpy(dtype=float))
+    print("conseq   legacy[s]  grouped[s]  monthly[s]  equal")
+    print("{:7}  {:9.3f}  {:10.4f}  {:10.4f}  {}".format(len(df), legacy_time, summary_time, monthly_time, equal))
+
+def bench_stat(folder, regions):
+    #accidents per region and year, loop over rows against bincount
+    data = offline_downloader(folder).get_list(columns = ["p2a", "p99"])
+    legacy, legacy_time = timed(legacy_stat_counts, data)
+    (names, years, counts), counted_time = timed(get_stat.count_accidents, data)
+    equal = list(names) == list(legacy) and all(legacy[name].get(str(year), 0) == count for name, row in zip(names, counts) for year, count in zip(years, row))
+    print("stat     legacy[s]  counted[s]  equal")
+    print("{:7}  {:9.3f}  {:10.4f}  {}".format(len(data[1][0]), legacy_time, counted_time, equal))
+
+def bench_aggregates(folder, regions):
+    #report aggregates computed from data, from aggregate cache and again after one region cache is rewritten
+    reports = [
+        (get_stat.count_accidents, (), {"source" : "list", "columns" : ["p2a", "p99"]}),
+        (analysis.summarize_consequences, ("region",), {}),
+        (analysis.damage_counts, (["PHA", "JHM", "OLK", "LBK"],), {}),
+        (analysis.surface_counts, (["KVK", "PHA", "JHM", "OLK"], range(2016, 2021)), {})]
+
+    def render(cache):
+        return [cache.get(function, *args, **kwargs) for function, args, kwargs in reports]
+
+    def same(first, second):
+        return all(a.equals(b) if isinstance(a, pd.DataFrame) else all(np.array_equal(x, y) for x, y in zip(a, b)) for a, b in zip(first, second))
+
+    with tempfile.TemporaryDirectory() as aggregates:
+        downloader = offline_downloader(folder)
+        downloader.get_list()
+        computed, computed_time = timed(render, AggregateCache(offline_downloader(folder), folder=aggregates))
+        warm = AggregateCache(offline_downloader(folder), folder=aggregates)
+        cached, cached_time = timed(render, warm)
+
+        #rewritten cache changes fingerprint of data
+        with open(downloader.manifest_path(regions[0])) as f:
+            downloader.save_cache(downloader.load_cache(regions[0]), regions[0], json.load(f))
+        changed = AggregateCache(offline_downloader(folder), folder=aggregates)
+        _, changed_time = timed(render, changed)
+
+        print("computed[s]  cached[s]  hits  changed[s]  misses  equal")
+        print("{:11.3f}  {:9.4f}  {:4}  {:10.3f}  {:6}  {}".format(computed_time, cached_time, warm.hits, changed_time, changed.misses, same(computed, cached)))
+
+def run_suite(folder, regions, repeat = 3):
+    #time main stages of the pipeline, each is the best of repeat runs, returns {stage : seconds}
+    results = dict()
+
+    def best(name, function, *args, setup = None):
+        times = list()
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            times.append(timed(function, *args)[1])
+        results[name] = min(times)
+
+    region = regions[0]
+    pickled = offline_downloader(folder, cache_filename="suite_{}.pkl.gz")
+    columnar = offline_downloader(folder, cache_filename="suite_{}")
+
+    best("parse_region_data", pickled.parse_region_data, region)
+    best("get_list_parse", lambda: offline_downloader(folder, cache_filename="suite_{}.pkl.gz").get_list(regions),
+         setup = lambda: remove_cache(folder, "suite_{}.pkl.gz"))
+    best("get_list_cache", lambda: offline_downloader(folder, cache_filename="suite_{}.pkl.gz").get_list(regions))
+
+    region_data = pickled.parse_region_data(region)
+    best("save_pickle", pickled.save_cache, region_data, region)
+    best("load_pickle", pickled.load_cache, region)
+    best("save_columns", columnar.save_cache, region_data, region)
+    best("load_columns", columnar.load_cache, region)
+
+    #accidents.pkl.gz of the assignment has floats and strings, get_dataframe has to convert it
+    data = offline_downloader(folder, cache_filename="suite_{}").get_list()
+    frame = pd.DataFrame({("region" if key == "p99" else key) : column.decode() if hasattr(column, "decode") else integer_as_float(column)
+                          for key, column in zip(*data)})
+    frame["p2a"] = frame["p2a"].astype(str)
+    frame.to_pickle(folder + "/suite_accidents.pkl.gz")
+    best("get_dataframe", analysis.get_dataframe, folder + "/suite_accidents.pkl.gz")
+
+    #aggregations of plot functions on all regions
+    df = columnar.list_to_dataframe(data)
+    best("count_accidents", get_stat.count_accidents, (["p2a", "p99"], [data[1][data[0].index("p2a")], data[1][data[0].index("p99")]]))
+    best("summarize_consequences", analysis.summarize_consequences, df, "region")
+    best("damage_counts", analysis.damage_counts, df, ["PHA", "JHM", "OLK", "LBK"])
+    best("surface_counts", analysis.surface_counts, df, ["KVK", "PHA", "JHM", "OLK"], range(2016, 2021))
+
+    remove_cache(folder, "suite_{}.pkl.gz")
+    remove_cache(folder, "suite_{}")
+    os.remove(folder + "/suite_accidents.pkl.gz")
+    return results
+
+def bench_suite(folder, regions):
+    #timing of pipeline stages that can be saved and compared across commits
+    results = run_suite(folder, regions)
+    print("stage                   best[s]")
+    for name, seconds in results.items():
+        print("{:22}  {:8.4f}".format(name, seconds))
+    return results
+
+def git_commit():
+    #commit of the working tree, marked if there are uncommitted changes, None outside of git
+    directory = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=directory, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+def save_results(path, parameters, results):
+    #append results with parameters of the run and commit as one line of JSON
+    entry = {"commit" : git_commit(), "time" : time.strftime("%Y-%m-%dT%H:%M:%S"), "parameters" : parameters,
+             "versions" : {"python" : sys.version.split()[0], "numpy" : np.__version__, "pandas" : pd.__version__},
+             "results" : results}
+    with open(path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+def compare_results(path, parameters, results):
+    #print results next to the last saved ones of a run with the same parameters
+    previous = None
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry["parameters"] == parameters:
+                    previous = entry
+    if previous is None:
+        print("No saved results with the same parameters in {}".format(path), file=sys.stderr)
+        return
+
+    print("\n[compare with {}]".format(previous["commit"]))
+    print("stage                   saved[s]     now[s]   change")
+    for benchmark, stages in results.items():
+        for name, seconds in stages.items():
+            saved = previous["results"].get(benchmark, dict()).get(name)
+            if saved is None:
+                print("{:22}  {:>8}  {:9.4f}".format(name, "-", seconds))
+            else:
+                print("{:22}  {:8.4f}  {:9.4f}  {:+6.1f}%".format(name, saved, seconds, (seconds / saved - 1) * 100 if saved else 0.0))
+
+benchmarks = {
+    "parse" : bench_parse,
+    "merge" : bench_merge,
+    "load" : bench_load,
+    "workers" : bench_workers,
+    "download" : bench_download,
+    "cache" : bench_cache,
+    "select" : bench_select,
+    "memory" : bench_memory,
+    "update" : bench_update,
+    "sidefiles" : bench_sidefiles,
+    "batches" : bench_batches,
+    "surface" : bench_surface,
+    "damage" : bench_damage,
+    "conseq" : bench_conseq,
+    "stat" : bench_stat,
+    "aggregates" : bench_aggregates,
+    "suite" : bench_suite
+}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark parsing of synthetic accident archives")
+    parser.add_argument('--rows', type=int, metavar='N', default=2000, help="rows per region csv")
+    parser.add_argument('--years', type=int, metavar='N', default=4, help="number of yearly archives")
+    parser.add_argument('--regions', nargs='+', metavar='REGION', default=["PHA", "JHM", "KVK"])
+    parser.add_argument('--save', type=str, metavar='file', default=None, help="append results of suite to JSON lines file")
+    parser.add_argument('--compare', type=str, metavar='file', default=None, help="compare results of suite with the last ones saved in file")
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK', default=list(benchmarks), help="any of: " + ", ".join(benchmarks))
+    args = parser.parse_args()
+
+    #benchmarks returning results can be saved, runs are comparable only with the same parameters
+    parameters = {"rows" : args.rows, "years" : args.years, "regions" : args.regions}
+    results = dict()
+    with tempfile.TemporaryDirectory() as folder:
+        make_folder(folder, range(2016, 2016 + args.years), args.rows)
+        for name in args.benchmarks:
+            print("\n[{}]".format(name))
+            result = benchmarks[name](folder, args.regions)
+            if result is not None:
+                results[name] = result
+
+    if args.compare is not None:
+        compare_results(args.compare, parameters, results)
+    if args.save is not None:
+        save_results(args.save, parameters, results)
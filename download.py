@@ -1,8 +1,80 @@
 from bs4 import BeautifulSoup
-from copy import deepcopy
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import formatdate
 import numpy as np
+import pandas as pd
 import zipfile as zf
-import os, sys, requests, re, csv, io, pickle, gzip
+import os, sys, requests, re, pickle, gzip, json, shutil, hashlib
+import instrument
+
+class EncodedArray(np.ndarray):
+
+    #string column stored as integer codes into a sorted array of its distinct values (categories),
+    #lossless counterpart of pandas.Categorical.from_codes(codes, categories)
+
+    def __new__(cls, codes, categories):
+        array = np.asarray(codes).view(cls)
+        array.categories = np.asarray(categories)
+        return array
+
+    def __array_finalize__(self, obj):
+        self.categories = getattr(obj, "categories", None)
+
+    def __reduce__(self):
+        #keep categories when pickled to cache or sent to worker process
+        constructor, args, state = super().__reduce__()
+        return (constructor, args, (state, self.categories))
+
+    def __setstate__(self, state):
+        super().__setstate__(state[0])
+        self.categories = state[1]
+
+    @staticmethod
+    def code_dtype(size):
+        #smallest integer type able to index given number of categories
+        for dtype in (np.int8, np.int16, np.int32):
+            if size <= np.iinfo(dtype).max + 1:
+                return dtype
+        return np.int64
+
+    @classmethod
+    def encode(cls, values, width = None):
+        #encode sequence of strings, values are cut to width characters first if given,
+        #distinct values are found by pandas so only they are handled in python
+        codes, distinct = pd.factorize(np.asarray(values, dtype=object))
+        cut = [value[:width] for value in distinct]
+        categories = sorted(set(cut))
+        index = {category : i for i, category in enumerate(categories)}
+        lookup = np.array([index[value] for value in cut], dtype=cls.code_dtype(len(categories)))
+        return cls(lookup[codes] if len(lookup) else np.zeros(len(codes), dtype=lookup.dtype), np.array(categories, dtype=str))
+
+    @classmethod
+    def concatenate(cls, arrays):
+        #concatenate encoded arrays, categories are merged and codes remapped to them
+        categories = np.unique(np.concatenate([array.categories for array in arrays]))
+        dtype = cls.code_dtype(len(categories))
+        codes = [np.searchsorted(categories, array.categories).astype(dtype)[array.codes] for array in arrays]
+        return cls(np.concatenate(codes), categories)
+
+    def copy(self, order = 'C'):
+        #copy sharing neither codes nor categories with the original
+        return EncodedArray(self.codes.copy(order), self.categories.copy())
+
+    @property
+    def codes(self):
+        return self.view(np.ndarray)
+
+    def decode(self):
+        #fixed width string array with the original values
+        return self.categories[self.codes]
+
+    def codes_of(self, values):
+        #codes of given values, -1 for values not present in categories
+        values = np.asarray(values, dtype=str)
+        if len(self.categories) == 0:
+            return np.full(values.shape, -1)
+        positions = np.minimum(np.searchsorted(self.categories, values), len(self.categories) - 1)
+        return np.where(self.categories[positions] == values, positions, -1)
 
 class DataDownloader:
 
@@ -92,12 +164,94 @@ class DataDownloader:
         "p5a" : "Lokalita nehody",
         "p99" : "Region"
     }
+
+    #smallest dtype able to hold values of each column, strings are stored encoded with at most given width
+    #missing values are NaN for floats, NaT for dates and the minimum of the type for integers (see missing_value)
+    column_dtypes = {
+        "p1" : "int64",
+        "p36" : "int8",
+        "p37" : "int32",
+        "p2a" : "datetime64[D]",
+        "weekday(p2a)" : "int8",
+        "p2b" : "int16",
+        "p6" : "int8",
+        "p7" : "int8",
+        "p8" : "int8",
+        "p9" : "int8",
+        "p10" : "int8",
+        "p11" : "int8",
+        "p12" : "int16",
+        "p13a" : "int16",
+        "p13b" : "int16",
+        "p13c" : "int16",
+        "p14" : "int32",
+        "p15" : "int8",
+        "p16" : "int8",
+        "p17" : "int8",
+        "p18" : "int8",
+        "p19" : "int8",
+        "p20" : "int8",
+        "p21" : "int8",
+        "p22" : "int8",
+        "p23" : "int8",
+        "p24" : "int8",
+        "p27" : "int8",
+        "p28" : "int8",
+        "p34" : "int16",
+        "p35" : "int16",
+        "p39" : "int8",
+        "p44" : "int8",
+        "p45a" : "int8",
+        "p47" : "int16",
+        "p48a" : "int8",
+        "p49" : "int8",
+        "p50a" : "int8",
+        "p50b" : "int8",
+        "p51" : "int8",
+        "p52" : "int8",
+        "p53" : "int32",
+        "p55a" : "int8",
+        "p57" : "int8",
+        "p58" : "int8",
+        "a" : "float64",
+        "b" : "float64",
+        "d" : "float64",
+        "e" : "float64",
+        "f" : "float64",
+        "g" : "float64",
+        "h" : "U64",
+        "i" : "U64",
+        "j" : "float64",
+        "k" : "U32",
+        "l" : "U8",
+        "n" : "float64",
+        "o" : "float64",
+        "p" : "U16",
+        "q" : "U16",
+        "r" : "int32",
+        "s" : "int32",
+        "t" : "U32",
+        "p5a" : "int8",
+        "p99" : "U8"
+    }
+
+    #name of monthly snapshot archive e.g. datagis-09-2020.zip, groups are month and year
+    snapshot_regex = re.compile(r'(1[0-2]|0[1-9])-(\d{4})')
+
+    #file in data folder with ETag and Last-Modified of downloaded archives
+    download_state_filename = "download_state.json"
+
+    #columns using decimal comma
+    decimal_comma_columns = ("a", "b", "d", "e", "f", "g", "o")
     
-    def __init__(self,url='https://ehw.fit.vutbr.cz/izv/', folder="data", cache_filename='data_{}.pkl.gz'):
+    def __init__(self,url='https://ehw.fit.vutbr.cz/izv/', folder="data", cache_filename='data_{}.pkl.gz', offline = False):
         
         self.url = url
         self.folder = folder
         self.cache_filename = cache_filename
+
+        #offline downloader never downloads, it uses only caches and archives already in folder
+        self.offline = offline
         
         #variables for storing region data
         self.PHA = None
@@ -119,24 +273,31 @@ class DataDownloader:
         if not os.path.exists(folder):
             os.makedirs(folder)
         
-    def download_data(self):
+    @instrument.timed("download")
+    def download_data(self, workers = 4):
         
         #robots don't get access, so we add header
         headers = {'User-Agent' : 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/14.0 Safari/605.1.15'}
 
+        #one session for all requests, connections are reused by the download threads
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
         #GET website and parse with beautiful soup for download links
-        r = requests.get(self.url, headers = headers)
+        r = session.get(self.url, headers = headers)
         data = r.text
         soup = BeautifulSoup(data, features='html.parser')
         soup.prettify()
         links = soup.findAll('a', string = "ZIP", )
         last_month = -1
         regex =re.compile(r'(1[0-2]|0[1-9])-')
+        selected = list()
 
-        #download items - only download latest sets so we don't have redundant data
+        #select items - only download latest sets so we don't have redundant data
         for item in links:
             name = str(item).split('href=', 1)[1].split('"', 2)[1].split("/", 1)[1]
-            path = self.folder + '/' + name
             link = self.url + str(item).split('href=', 1)[1].split('"', 2)[1]
             
             if "2020" in name:
@@ -147,77 +308,262 @@ class DataDownloader:
 
             else:
                 if regex.search(name) is None:
-
-                    if not os.path.exists(path):
-                        r = requests.get(link, headers = headers)
-                        open(path, 'wb').write(r.content)
+                    selected.append((name, link))
 
         for item in links:
             name = str(item).split('href=', 1)[1].split('"', 2)[1].split("/", 1)[1]
+            link = self.url + str(item).split('href=', 1)[1].split('"', 2)[1]
 
             if "2020" in name:
                 month = int(name.split('-',1)[1].split('-',1)[0])
 
                 if month == last_month:
-                    
-                    #don't download already existing files
-                    if not os.path.exists(path):
-                        r = requests.get(link, headers = headers)
-                        open(path, 'wb').write(r.content)
+                    selected.append((name, link))
+
+        #download selected items concurrently, state keeps validators of downloaded files
+        state = self.load_download_state()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {name : pool.submit(self.download_file, session, headers, name, link, state.get(name, dict())) for name, link in selected}
+            for name in futures:
+                state[name] = futures[name].result()
+        self.save_download_state(state)
+        session.close()
+
+    def download_file(self, session, headers, name, link, file_state):
+        #download single file, returns validators (ETag, Last-Modified) of the local copy,
+        #validators of an unfinished download are kept under "partial" and used only to resume it
+        path = self.folder + '/' + name
+        part = path + '.part'
+        request_headers = dict(headers)
+        offset = 0
+        partial = file_state.get("partial", dict())
+        received = None
+
+        #unfinished download, continue where it ended if the file didn't change since
+        if os.path.exists(part) and (partial.get("etag") or partial.get("last_modified")):
+            offset = os.path.getsize(part)
+            request_headers['Range'] = 'bytes={}-'.format(offset)
+            request_headers['If-Range'] = partial.get("etag") or partial["last_modified"]
+
+        #file is already downloaded, ask only for a changed version
+        elif os.path.exists(path) and zf.is_zipfile(path):
+            if file_state.get("etag"):
+                request_headers['If-None-Match'] = file_state["etag"]
+            if file_state.get("last_modified"):
+                request_headers['If-Modified-Since'] = file_state["last_modified"]
+            if not file_state.get("etag") and not file_state.get("last_modified"):
+                request_headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+
+        try:
+            with session.get(link, headers = request_headers, stream = True, timeout = 60) as r:
+                if r.status_code == 304:
+                    instrument.count("download_not_modified")
+                    return file_state
+
+                #part is already complete or invalid, start over
+                if r.status_code == 416:
+                    os.remove(part)
+                    return self.download_file(session, headers, name, link, {key : value for key, value in file_state.items() if key != "partial"})
+
+                r.raise_for_status()
+                if r.status_code != 206:
+                    offset = 0
+
+                received = {"etag" : r.headers.get('ETag'), "last_modified" : r.headers.get('Last-Modified')}
+                expected = None if r.headers.get('Content-Encoding') else r.headers.get('Content-Length')
+
+                #stream to temporary file
+                with open(part, 'ab' if offset else 'wb') as f:
+                    written = 0
+                    for chunk in r.iter_content(chunk_size=2**16):
+                        f.write(chunk)
+                        written += len(chunk)
+                instrument.count("download_bytes", written)
+
+        except requests.RequestException as e:
+            print("Download of {} failed: {}".format(name, e), file=sys.stderr)
+            #local copy stays the old version, the new one can be resumed
+            return dict(file_state, partial=received) if received is not None else file_state
 
-    def parse_region_data(self,region):
+        if expected is not None and written != int(expected):
+            print("Download of {} is incomplete, it will be resumed next time".format(name), file=sys.stderr)
+            return dict(file_state, partial=received)
+
+        #whole file is downloaded, replace old version
+        os.replace(part, path)
+        return received
+
+    def load_download_state(self):
+        #validators of downloaded files saved by previous downloads
+        try:
+            with open(self.folder + '/' + DataDownloader.download_state_filename, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def save_download_state(self, state):
+        #temporary file is unique to the process so concurrent downloads don't replace each other's
+        path = self.folder + '/' + DataDownloader.download_state_filename
+        temporary = "{}.{}.part".format(path, os.getpid())
+        with open(temporary, 'w') as f:
+            json.dump(state, f)
+        os.replace(temporary, path)
+
+    def parse_region_data(self, region, files = None):
         #self.download_data()
+        return self.parse_regions([region], files)[region]
 
-        parsed_data = (list(), list())
+    def parse_regions(self, regions, files = None, columns = None, filters = None):
+        #parse data of several regions, each archive is opened only once
+        #only given columns are parsed and only rows matching filters are kept
+        if columns is None:
+            columns = list(DataDownloader.column_types.keys())
+        archives = self.parse_archives(regions, files, columns, filters)
 
-        #intialize first list in the tuple and fill it with strings corresponding to column type of csv file
-        for value in DataDownloader.column_types.keys():
-            parsed_data[0].append(value)
-        
-        #go through the folder
-        for file in os.listdir(self.folder):
+        parsed = dict()
+        for region in regions:
+
+            #intialize first list in the tuple and fill it with strings corresponding to column type of csv file
+            parsed[region] = (list(columns), self.merge_nd_lists([chunk for _, _, chunk in archives[region]], columns))
+                    
+        return parsed
+
+    def parse_archives(self, regions, files = None, columns = None, filters = None):
+        #parse regions from every archive separately, returns list of (file, signature, arrays) in order of archives for each region
+        #signature is CRC and size of the region csv file, it changes only when data of region change
+        if columns is None:
+            columns = list(DataDownloader.column_types.keys())
+        needed = columns + [key for key in (filters or dict()) if key not in columns]
+
+        archives = {region : list() for region in regions}
+
+        #go through the archives, all of them in the folder if not given
+        if files is None:
+            files = self.archive_files()
+
+        for file in files:
             
-            #if file is zip we open it and look for specific region file based on region id e.g. "PHA"
-            if zf.is_zipfile(self.folder + '/' +file):
+            #open the zip and look for specific region files based on region id e.g. "PHA"
+            with zf.ZipFile(self.folder + '/' +file) as current_zip:
+                for region in regions:
+                    info = current_zip.getinfo(DataDownloader.region_match[region])
                 
-                current_zip = zf.ZipFile(self.folder + '/' +file)
-                
-                #we open the zip and the corresponding csv file
-                with current_zip.open(DataDownloader.region_match[region], 'r') as csvfile:
-                    current_csv = csv.reader(io.TextIOWrapper(csvfile, encoding="windows-1250"), delimiter=';')  
-                    csv_list = list(current_csv)
+                    #we open the corresponding csv file and parse it
+                    with instrument.stage("parse_csv") as stage, current_zip.open(info, 'r') as csvfile:
+                        chunk = self.parse_csv(csvfile, region, needed)
+                        stage.rows, stage.bytes = len(chunk[0]) if chunk else 0, info.file_size
+                    instrument.count("zip_bytes_read", info.compress_size)
+                    archives[region].append((file, [info.CRC, info.file_size], self.select_data((needed, chunk), columns, filters)[1]))
 
-                #parsing
+        return archives
 
-                    #if this is the first file we create the array, later we only append to it
-                    if len(parsed_data[1]) == 0:
+    def build_regions(self, regions, files = None):
+        #parse whole regions and save them to cache together with list of parsed archives
+        archives = self.parse_archives(regions, files)
+        return {region : self.save_archives(region, archives[region]) for region in regions}
 
-                        self.initialize_nd_list(parsed_data[1], len(csv_list))
-                        self.parse_csv(parsed_data[1], csv_list, region)
-                    
-                    #if this is not a first file, we create temp array and then append to ndarray
-                    else:
+    def save_archives(self, region, archives):
+        #merge parsed archives of region and save them to cache, returns region data
+        region_data = (list(DataDownloader.column_types.keys()), self.merge_nd_lists([chunk for _, _, chunk in archives]))
+        self.save_cache(region_data, region, [[file] + signature + [len(chunk[0])] for file, signature, chunk in archives])
+        return region_data
 
-                        #temp array
-                        numpy_parsed = list()
+    @instrument.timed("scan_archives")
+    def archive_files(self):
+        #names of zip files in the folder, sorted so the order of parsed rows is always the same
+        #monthly snapshots of a year contain all of the previous months, only the latest one is used,
+        #only .zip names are archives, .npz files saved next to caches by geo are zip files too
+        files = [file for file in sorted(os.listdir(self.folder))
+                 if file.endswith('.zip') and zf.is_zipfile(self.folder + '/' + file)]
+        snapshots = {file : DataDownloader.snapshot_regex.search(file) for file in files}
+        latest = dict()
+        for snapshot in snapshots.values():
+            if snapshot is not None:
+                latest[snapshot.group(2)] = max(latest.get(snapshot.group(2), ''), snapshot.group(1))
+        return [file for file in files if snapshots[file] is None or snapshots[file].group(1) == latest[snapshots[file].group(2)]]
 
-                        #prepare temp array with ndarrays of corresponding types where necessary, elsewhere leave float
-                        self.initialize_nd_list(numpy_parsed, len(csv_list))
+    @instrument.timed("scan_archives")
+    def archive_signatures(self, files, regions):
+        #signatures of region csv files in archives, only central directory of each archive is read
+        signatures = dict()
+        for file in files:
+            with zf.ZipFile(self.folder + '/' + file) as current_zip:
+                signatures[file] = dict()
+                for region in regions:
+                    info = current_zip.getinfo(DataDownloader.region_match[region])
+                    signatures[file][region] = [info.CRC, info.file_size]
+        return signatures
 
-                        #fill ndarrays with values
-                        self.parse_csv(numpy_parsed, csv_list, region)
-                        
-                        #concat to parent array
-                        for i, data in enumerate(numpy_parsed):
-                            parsed_data[1][i] = np.append(parsed_data[1][i], data, axis=0) 
-                    
-        #save region data to memory -- save it to instance variable
-        return(parsed_data)
+    def update_cache(self, regions = None):
+        #bring region caches up to date with archives in the folder, only new or changed archives are parsed,
+        #rows of archives that were removed or superseded are dropped, returns list of updated regions
+        if regions is None:
+            regions = list(DataDownloader.region_match)
+        files = self.archive_files()
+        signatures = self.archive_signatures(files, regions)
 
-    def get_list(self, regions = None):
+        #for each region and archive keep range of rows from cache or None if it has to be parsed
+        plans = dict()
+        rebuild = list()
+        for region in regions:
+            try:
+                region_data = self.load_cache(region)
+                with open(self.manifest_path(region), 'r') as f:
+                    manifest = json.load(f)
+            except:
+                rebuild.append(region)
+                continue
+
+            #manifest of another version of the cache, its row ranges can't be used
+            if sum(entry[3] for entry in manifest) != (len(region_data[1][0]) if region_data[1] else 0):
+                rebuild.append(region)
+                continue
+
+            cached = dict()
+            start = 0
+            for file, crc, size, rows in manifest:
+                cached[file] = ([crc, size], (start, start + rows))
+                start += rows
+
+            plan = list()
+            for file in files:
+                if file in cached and cached[file][0] == signatures[file][region]:
+                    plan.append((file, cached[file][1]))
+                else:
+                    plan.append((file, None))
+
+            if [file for file, _ in plan] != [entry[0] for entry in manifest] or any(rows is None for _, rows in plan):
+                plans[region] = (region_data, plan)
+
+        #parse every needed archive once for all regions that need it
+        parsed = dict()
+        for file in files:
+            needing = [region for region in plans if (file, None) in plans[region][1]]
+            if needing:
+                archives = self.parse_archives(needing, [file])
+                for region in needing:
+                    parsed[(region, file)] = archives[region][0]
+
+        #splice cached rows with new ones
+        for region, (region_data, plan) in plans.items():
+            archives = list()
+            for file, rows in plan:
+                if rows is None:
+                    archives.append(parsed[(region, file)])
+                else:
+                    archives.append((file, signatures[file][region], [column[rows[0]:rows[1]] for column in region_data[1]]))
+            setattr(self, region, self.save_archives(region, archives))
+
+        for region, region_data in self.build_regions(rebuild, files).items():
+            setattr(self, region, region_data)
+
+        return list(plans) + rebuild
+
+    def get_list(self, regions = None, workers = 1, columns = None, filters = None, update = False):
 
         #download data, doesn't download duplicate data
-        self.download_data()
+        if not self.offline:
+            self.download_data()
         region_list = None
         #return data on all regions
         if regions == None:
@@ -228,37 +574,182 @@ class DataDownloader:
                 return
             region_list = regions
 
+        #only given columns are loaded, all of them if not given
+        if columns is None:
+            columns = list(DataDownloader.column_types.keys())
+        for key in list(columns) + list(filters or dict()):
+            if key not in DataDownloader.column_types:
+                print("Column {} doesn't exist".format(key), file=sys.stderr)
+                return
+        needed = list(columns) + [key for key in (filters or dict()) if key not in columns]
+
         full_data = (list(), list())
-        for value in DataDownloader.column_types.keys():
+        for value in columns:
             full_data[0].append(value)
-        self.initialize_nd_list(full_data[1], 0)
+
+        #parse only archives that changed since caches were saved
+        if update:
+            self.update_cache([region for region in region_list if region in DataDownloader.region_match])
+
+        #data of each region and regions that have to be parsed
+        region_data = dict()
+        missing = list()
 
         for region in region_list:
             if region not in DataDownloader.region_match:
                 print("Region {} doesn't exist".format(region), file=sys.stderr)
                 continue
-            region_data = None
 
             #try to get data from variable
             if getattr(self, region) is not None:
-                region_data = getattr(self, region)
+                region_data[region] = getattr(self, region)
 
-            #try to open from file if it fails, start parsing
-            else:
+            #try to open from file if it fails, parse it later
+            elif region not in missing:
                 try:
-                    region_data = self.load_pickle(region)
-                    #print(region_data)
+                    region_data[region] = self.load_cache(region, needed)
+                    instrument.count("region_cache_hits")
                 except:
-                    region_data = self.get_region(region)
-                    #cache data and save to memory
-                    self.save_pickle(region_data, region)
-                    setattr(self, region, deepcopy(region_data))
+                    missing.append(region)
+                    instrument.count("region_cache_misses")
 
-            for i, data in enumerate(region_data[1]):
-                full_data[1][i] = np.append(full_data[1][i], data, axis=0)
+        if workers > 1 and len(missing) > 0:
+            region_data.update(self.parse_regions_parallel(missing, workers))
+        elif len(missing) > 0:
+            region_data.update(self.build_regions(missing))
+            for region in missing:
+                #save to memory, get_list copies them so callers can't modify them
+                setattr(self, region, region_data[region])
+
+        #merge regions in the requested order
+        chunks = [self.select_data(region_data[region], columns, filters)[1] for region in region_list if region in region_data]
+
+        #single region is returned as it is, if it's kept in memory callers get a copy so they can't modify it,
+        #arrays loaded from cache are passed through
+        kept = [region for region in region_list if region in region_data and region_data[region] is getattr(self, region)]
+        if len(chunks) == 1 and kept and not filters:
+            chunks = [[column.copy() for column in chunks[0]]]
+        full_data[1].extend(self.merge_nd_lists(chunks, columns))
             
         return full_data
 
+    def iter_batches(self, regions = None, batch_size = 100000, columns = None, filters = None):
+        #yield data of regions in batches of batch_size rows as (column names, list of ndarrays), the last one may be smaller
+        #regions are read from memory or cache when present, otherwise streamed from archives without caching
+        #only the current batch is held in memory, except for gzip pickle caches that are loaded whole
+        if regions is None:
+            regions = list(DataDownloader.region_match)
+        if columns is None:
+            columns = list(DataDownloader.column_types.keys())
+        needed = list(columns) + [key for key in (filters or dict()) if key not in columns]
+
+        pending = list()
+        count = 0
+        for chunk in self.iter_chunks(regions, batch_size, needed):
+            pending.append(self.select_data((needed, chunk), columns, filters)[1])
+            count += len(pending[-1][0])
+
+            while count >= batch_size:
+                merged = self.merge_nd_lists(pending, columns)
+                yield (list(columns), [column[:batch_size] for column in merged])
+                pending = [[column[batch_size:] for column in merged]]
+                count -= batch_size
+
+        if count > 0:
+            yield (list(columns), self.merge_nd_lists(pending, columns))
+
+    def iter_chunks(self, regions, size, columns):
+        #yield lists of ndarrays with at most size rows of given regions
+        for region in regions:
+            if region not in DataDownloader.region_match:
+                print("Region {} doesn't exist".format(region), file=sys.stderr)
+                continue
+
+            #batches of data kept in memory are copied so callers can't modify them
+            region_data = getattr(self, region)
+            kept = region_data is not None
+            if region_data is None:
+                try:
+                    region_data = self.load_cache(region, columns)
+                except:
+                    region_data = None
+
+            if region_data is not None:
+                region_data = self.select_data(region_data, columns)
+                for start in range(0, len(region_data[1][0]), size):
+                    yield [column[start:start + size].copy() if kept else column[start:start + size] for column in region_data[1]]
+                continue
+
+            #stream rows from csv files
+            for file in self.archive_files():
+                with zf.ZipFile(self.folder + '/' + file) as current_zip:
+                    with current_zip.open(DataDownloader.region_match[region], 'r') as csvfile:
+                        for frame in self.read_csv(csvfile, columns, size):
+                            yield self.parse_frame(frame, region, columns)
+
+    def parse_regions_parallel(self, regions, workers):
+        #parse regions in worker processes
+        files = self.archive_files()
+        parsed = dict()
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+
+            #enough regions to keep workers busy, each worker parses a group of regions and saves their cache files
+            if len(regions) >= workers or len(files) < 2:
+                groups = [regions[i::workers] for i in range(min(workers, len(regions)))]
+                futures = [pool.submit(DataDownloader.parse_regions_task, self.folder, self.cache_filename, group, files, True) for group in groups]
+                for future in futures:
+                    parsed.update(future.result())
+
+            #otherwise each worker parses all regions from one archive, merged and cached here
+            else:
+                futures = [pool.submit(DataDownloader.parse_regions_task, self.folder, self.cache_filename, regions, [file], False) for file in files]
+                parts = [future.result() for future in futures]
+                for region in regions:
+                    parsed[region] = self.save_archives(region, [part[region][0] for part in parts])
+
+        for region in regions:
+            setattr(self, region, parsed[region])
+        return parsed
+
+    @staticmethod
+    def parse_regions_task(folder, cache_filename, regions, files, save):
+        #parse regions in a worker process, either whole and saved to cache or by archives
+        downloader = DataDownloader(folder=folder, cache_filename=cache_filename)
+        if save:
+            return downloader.build_regions(regions, files)
+        return downloader.parse_archives(regions, files)
+
+    def to_dataframe(self, regions = None, columns = None, filters = None):
+        #load regions to pandas DataFrame with types given by column_dtypes, arrays are not copied where pandas can use them
+        #integers with missing values become float with NaN (float32 up to int16, float64 for wider ones),
+        #strings category, p99 is renamed to region and date is added
+        data = self.get_list(regions, columns=columns, filters=filters)
+        if data is None:
+            return
+        return self.list_to_dataframe(data)
+
+    def list_to_dataframe(self, data):
+        #DataFrame of data returned by get_list, see to_dataframe
+        frame = dict()
+        for key, column in zip(*data):
+            if isinstance(column, EncodedArray):
+                values = pd.Categorical.from_codes(column.codes, column.categories)
+            elif column.dtype.kind == 'M':
+                values = column.astype("datetime64[ns]")
+            #float32 holds int8 and int16 exactly, wider ones like ids in p1 need float64
+            elif column.dtype.kind == 'i' and np.any(column == DataDownloader.missing_value(key)):
+                values = self.to_float(key, column).astype(np.float32 if column.dtype.itemsize <= 2 else np.float64)
+            elif column.dtype.kind == 'f':
+                values = column.astype(np.float32)
+            else:
+                values = column
+            frame["region" if key == "p99" else key] = values
+
+        if "p2a" in frame:
+            frame["date"] = frame["p2a"]
+        return pd.DataFrame(frame, copy=False)
+
     def get_region(self, region):
         #get single region data
         region_data = None
@@ -266,6 +757,108 @@ class DataDownloader:
             region_data = self.parse_region_data(region)
         return region_data
 
+    def save_cache(self, region_data, region, archives = None):
+        #cache file names without extension are directories with one file per column, others are gzip pickles,
+        #old manifest is removed first so it's never left next to a new cache if saving is interrupted
+        if os.path.exists(self.manifest_path(region)):
+            os.remove(self.manifest_path(region))
+        with instrument.stage("save_cache") as stage:
+            if self.columnar_cache():
+                self.save_columns(region_data, region)
+            else:
+                self.save_pickle(region_data, region)
+            stage.rows = len(region_data[1][0]) if region_data[1] else 0
+            stage.bytes = self.cache_size(region) if instrument.enabled else 0
+
+        #list of archives with signature and number of rows is saved next to cache for incremental updates,
+        #written through temporary file so it's never read incomplete
+        if archives is not None:
+            temporary = "{}.{}.tmp".format(self.manifest_path(region), os.getpid())
+            with open(temporary, 'w') as f:
+                json.dump(archives, f)
+            os.replace(temporary, self.manifest_path(region))
+
+    def manifest_path(self, region):
+        return self.folder + '/' + self.cache_filename.format(region) + '.archives.json'
+
+    def fingerprint(self, regions = None):
+        #hash identifying data in caches of regions, changes whenever a cache is rewritten,
+        #manifest is hashed whole as it holds signatures of parsed archives, cache only by its file stats
+        digest = hashlib.sha1()
+        for region in (regions if regions is not None else DataDownloader.region_match):
+            digest.update(region.encode())
+            path = self.folder + '/' + self.cache_filename.format(region)
+            if os.path.exists(path):
+                stat = os.stat(path)
+                digest.update("{} {} {}".format(stat.st_ino, stat.st_size, stat.st_mtime_ns).encode())
+            if os.path.exists(self.manifest_path(region)):
+                with open(self.manifest_path(region), 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def load_cache(self, region, columns = None):
+        #load given columns of region, gzip pickle has to be loaded whole
+        with instrument.stage("load_cache") as stage:
+            if self.columnar_cache():
+                region_data = self.load_columns(region, columns)
+            else:
+                region_data = self.select_data(self.load_pickle(region), columns)
+            stage.rows = len(region_data[1][0]) if region_data[1] else 0
+            stage.bytes = self.cache_size(region) if instrument.enabled else 0
+        return (region_data[0], [self.conform_column(key, column) for key, column in zip(*region_data)])
+
+    def cache_size(self, region):
+        #size of cache of region in bytes, of all its files for columnar cache
+        path = self.folder + '/' + self.cache_filename.format(region)
+        if os.path.isdir(path):
+            return sum(os.path.getsize(path + '/' + name) for name in os.listdir(path))
+        return os.path.getsize(path)
+
+    def conform_column(self, key, column):
+        #convert column from cache written by older version to current types
+        if column.dtype.kind == 'U':
+            return EncodedArray.encode(column.tolist())
+        if column.dtype == np.float64 and np.dtype(DataDownloader.column_dtypes[key]).kind == 'i':
+            return self.narrow_column(key, column)
+        return column
+
+    def columnar_cache(self):
+        return os.path.splitext(self.cache_filename)[1] == ''
+
+    def save_columns(self, region_data, region):
+        #save every column as .npy file, written to temporary directory first so the cache is never incomplete
+        path = self.folder + '/' + self.cache_filename.format(region)
+        if os.path.exists(path + '.tmp'):
+            shutil.rmtree(path + '.tmp')
+        os.makedirs(path + '.tmp')
+
+        for name, column in zip(region_data[0], region_data[1]):
+            if isinstance(column, EncodedArray):
+                np.save(path + '.tmp/' + name + '.categories.npy', column.categories, allow_pickle=False)
+                column = column.codes
+            np.save(path + '.tmp/' + name + '.npy', column, allow_pickle=False)
+        with open(path + '.tmp/columns.json', 'w') as f:
+            json.dump(list(region_data[0]), f)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.rename(path + '.tmp', path)
+
+    def load_columns(self, region, columns = None):
+        #memory map columns of the region, only the requested ones if given
+        path = self.folder + '/' + self.cache_filename.format(region)
+        with open(path + '/columns.json', 'r') as f:
+            names = json.load(f)
+        if columns is None:
+            columns = names
+        nd_list = list()
+        for name in columns:
+            column = np.load(path + '/' + name + '.npy', mmap_mode='r', allow_pickle=False)
+            if os.path.exists(path + '/' + name + '.categories.npy'):
+                column = EncodedArray(column, np.load(path + '/' + name + '.categories.npy', allow_pickle=False))
+            nd_list.append(column)
+        return (list(columns), nd_list)
+
     def save_pickle(self, region_data, region):
         with gzip.GzipFile(self.folder + '/' + self.cache_filename.format(region), mode='wb') as f:
             pickle.dump(region_data, f)
@@ -275,44 +868,197 @@ class DataDownloader:
             region_data = pickle.load(f)
             return region_data
 
-    def initialize_nd_list(self, nd_list, len):
-        #create list of ndarrays with correct types)
-        for key in DataDownloader.column_types:
-            if key == "p2a":
-                nd_list.append(np.zeros([len], dtype = "datetime64[D]"))
-            elif key == "h" or key == "i":
-                nd_list.append(np.zeros([len], dtype = "U64"))
-            elif key == "k" or key == "t":
-                nd_list.append(np.zeros([len], dtype = "U32"))
-            elif key == "l" or key == "p99":
-                nd_list.append(np.zeros([len], dtype = "U8"))
-            elif key == "p" or key == "q":
-                nd_list.append(np.zeros([len], dtype = "U16"))
+    def initialize_nd_list(self, nd_list, len, columns = None):
+        #create list of ndarrays with correct types, for all columns if not given
+        if columns is None:
+            columns = DataDownloader.column_types
+        for key in columns:
+            dtype = DataDownloader.column_dtypes[key]
+            if np.dtype(dtype).kind == 'U':
+                nd_list.append(EncodedArray(np.zeros([len], dtype = np.int8), np.array([], dtype = dtype)))
             else:
-                nd_list.append(np.zeros([len]))
-    
-    def parse_csv(self, nd_list, csv_list, region):
-        #parse csv file and save values to list of ndarrays
-        for i, row in enumerate(csv_list):
-            for ((j, cell), ct) in zip(enumerate(row), DataDownloader.column_types):
-                if ct == "p2a":
-                    nd_list[j][i] = np.datetime64(cell)   
-                elif ct == "p47" and cell.upper() =="XX":
-                    nd_list[j][i] = -1
-                elif ',' in cell and (ct == "a" or ct == "b" or ct == "d" or ct =="e" or ct == "f" or ct =="g" or ct == "o"):
-                    nd_list[j][i] = float(cell.replace(',','.',1))
-                elif cell == '':
-                    nd_list[j][i] = np.nan
+                nd_list.append(np.zeros([len], dtype = dtype))
+
+    def merge_nd_lists(self, chunks, columns = None):
+        #concatenate lists of ndarrays column by column, each column is allocated only once
+        chunks = [chunk for chunk in chunks if len(chunk) != 0]
+        if len(chunks) == 0:
+            nd_list = list()
+            self.initialize_nd_list(nd_list, 0, columns)
+            return nd_list
+        if len(chunks) == 1:
+            return list(chunks[0])
+        if columns is None:
+            columns = list(DataDownloader.column_types.keys())
+
+        nd_list = list()
+        with instrument.stage("merge") as stage:
+            for key, arrays in zip(columns, zip(*chunks)):
+                if isinstance(arrays[0], EncodedArray):
+                    nd_list.append(EncodedArray.concatenate(arrays))
+
+                #some of the chunks didn't fit its type, merge as float
+                elif len(set(array.dtype for array in arrays)) > 1:
+                    nd_list.append(np.concatenate([self.to_float(key, array) for array in arrays]))
+                else:
+                    nd_list.append(np.concatenate(arrays))
+            stage.rows = len(nd_list[0]) if nd_list else 0
+        return nd_list
+
+    def select_data(self, region_data, columns = None, filters = None):
+        #project data to given columns and keep only rows matching all filters
+        #filter is a value, list or set of values or a slice with range [start, stop) e.g. {"p2a" : slice("2019-01-01", "2020-01-01")}
+        names = list(region_data[0])
+        if columns is None:
+            columns = names
+        selected = [region_data[1][names.index(key)] for key in columns]
+
+        mask = None
+        for key, condition in (filters or dict()).items():
+            column = region_data[1][names.index(key)]
+
+            #encoded strings are compared by codes, categories are sorted so ranges are kept
+            if isinstance(column, EncodedArray):
+                if isinstance(condition, slice):
+                    condition = slice(None if condition.start is None else np.searchsorted(column.categories, condition.start),
+                                      None if condition.stop is None else np.searchsorted(column.categories, condition.stop))
+                elif isinstance(condition, (list, tuple, set)):
+                    condition = column.codes_of(list(condition))
                 else:
-                    try:
-                        nd_list[j][i] = cell
-                    except:
-                        try:
-                            nd_list[j][i] = float.fromhex(cell)
-                        except:
-                            nd_list[j][i] = np.nan
-            nd_list[-1][i] = region
+                    condition = column.codes_of([condition])[0]
+                column = column.codes.astype(np.int64)
+
+            if isinstance(condition, slice):
+                matching = np.ones(column.shape, dtype=bool)
+                if condition.start is not None:
+                    matching &= column >= DataDownloader.filter_value(condition.start, column.dtype)
+                if condition.stop is not None:
+                    matching &= column < DataDownloader.filter_value(condition.stop, column.dtype)
+            elif isinstance(condition, (list, tuple, set, np.ndarray)):
+                matching = np.isin(column, DataDownloader.filter_value(list(condition), column.dtype))
+            else:
+                matching = column == DataDownloader.filter_value(condition, column.dtype)
+
+            #missing integers are stored as minimum of the type, they match nothing as NaN did
+            if column.dtype.kind == 'i' and not isinstance(region_data[1][names.index(key)], EncodedArray):
+                matching &= column != np.iinfo(column.dtype).min
+            mask = matching if mask is None else mask & matching
+
+        if mask is not None:
+            selected = [column[mask] for column in selected]
+        return (list(columns), selected)
+
+    def parse_csv(self, csvfile, region, columns = None):
+        #parse whole csv file column by column and return list of typed ndarrays, for all columns if not given
+        return self.parse_frame(self.read_csv(csvfile, columns), region, columns)
+
+    def read_csv(self, csvfile, columns = None, chunksize = None):
+        #read given columns of csv file by pandas parser, returns DataFrame with columns named by keys
+        #or reader of DataFrames with at most chunksize rows, numbers are parsed by pandas including decimal comma,
+        #strings and dates are kept as str
+        keys = [key for key in DataDownloader.column_types if key != "p99"]
+        if columns is None:
+            columns = keys
+        dtypes = {key : object for key in keys if np.dtype(DataDownloader.column_dtypes[key]).kind in 'UM'}
+        try:
+            return pd.read_csv(csvfile, sep=';', encoding="windows-1250", header=None, names=keys, index_col=False,
+                               usecols=[key for key in keys if key in columns], dtype=dtypes, decimal=',',
+                               keep_default_na=False, na_values=[''], low_memory=False, chunksize=chunksize)
+        except pd.errors.EmptyDataError:
+            empty = pd.DataFrame({key : pd.Series(dtype=object) for key in keys if key in columns})
+            return empty if chunksize is None else iter([empty])
+
+    def parse_frame(self, frame, region, columns = None):
+        #convert DataFrame from read_csv to list of typed ndarrays
+        if columns is None:
+            columns = list(DataDownloader.column_types)
+        nd_list = list()
+        for key in columns:
+            #region is not in csv file
+            if key == "p99":
+                nd_list.append(EncodedArray(np.zeros([len(frame)], dtype = np.int8), np.array([region])))
+            else:
+                nd_list.append(self.parse_column(key, frame[key].to_numpy()))
+        return nd_list
+
+    def parse_column(self, key, column):
+        #convert a single column read by read_csv to ndarray of the type given by column_dtypes,
+        #missing cells are NaN
+        dtype = DataDownloader.column_dtypes[key]
+        if np.dtype(dtype).kind in 'UM':
+            column = np.where(pd.isna(column), '', column)
+            if np.dtype(dtype).kind == 'U':
+                return EncodedArray.encode(column, np.dtype(dtype).itemsize // 4)
+            return np.array(column, dtype=dtype)
+
+        #pandas couldn't parse column as numbers (e.g. XX or hex values), convert each unique value once
+        if column.dtype.kind not in 'iuf':
+            lookup = {cell : np.nan if not isinstance(cell, str) else DataDownloader.parse_float(
+                          key, cell.replace(',', '.', 1) if key in DataDownloader.decimal_comma_columns else cell)
+                      for cell in set(column)}
+            column = np.fromiter(map(lookup.__getitem__, column), dtype=np.float64, count=len(column))
+
+        return self.narrow_column(key, column.astype(np.float64, copy=False))
+
+    def narrow_column(self, key, values):
+        #convert float64 values to the type of column, missing values are replaced by sentinel
+        dtype = np.dtype(DataDownloader.column_dtypes[key])
+        if dtype.kind != 'i':
+            return values.astype(dtype, copy=False)
+
+        missing = np.isnan(values)
+        filled = np.where(missing, 0, values)
+        info = np.iinfo(dtype)
+        if filled.size > 0 and (np.any(filled != np.trunc(filled)) or filled.min() <= info.min or filled.max() > info.max):
+            print("Values of column {} don't fit {}, kept as float64".format(key, dtype), file=sys.stderr)
+            return values
+
+        narrowed = filled.astype(dtype)
+        narrowed[missing] = info.min
+        return narrowed
+
+    @staticmethod
+    def filter_value(value, dtype):
+        #value of filter comparable with column of dtype, numbers are compared in a wide type so values
+        #out of range of a narrow column or with a fraction don't overflow or get truncated, they just don't match
+        if dtype.kind in 'iuf':
+            value = np.asarray(value)
+            return value if value.dtype.kind in 'iuf' else value.astype(np.float64)
+        return np.asarray(value, dtype=dtype)
+
+    @staticmethod
+    def missing_value(key):
+        #value used for missing data in column
+        dtype = np.dtype(DataDownloader.column_dtypes[key])
+        if dtype.kind == 'i':
+            return np.iinfo(dtype).min
+        if dtype.kind == 'M':
+            return np.datetime64("NaT")
+        if dtype.kind == 'U':
+            return ''
+        return np.nan
+
+    @staticmethod
+    def to_float(key, column):
+        #float64 copy of numeric column with NaN for missing values
+        if column.dtype.kind != 'i':
+            return column.astype(np.float64)
+        values = column.astype(np.float64)
+        values[column == DataDownloader.missing_value(key)] = np.nan
+        return values
 
+    @staticmethod
+    def parse_float(key, cell):
+        #decimal value, then hex value, otherwise missing
+        if key == "p47" and cell.upper() == "XX":
+            return -1
+        try:
+            return float(cell)
+        except ValueError:
+            try:
+                return float.fromhex(cell)
+            except ValueError:
+                return np.nan
 
 if __name__ == "__main__":
     download = DataDownloader()
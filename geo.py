@@ -2,10 +2,21 @@
 # coding=utf-8
 import pandas as pd
 import geopandas
+import matplotlib
 import matplotlib.pyplot as plt
 import contextily as ctx
 import sklearn.cluster
 import numpy as np
+import pyproj
+import functools
+import requests
+import os
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from download import DataDownloader
+from aggregates import AggregateCache, evict_lru
+import instrument
 # muzeze pridat vlastni knihovny
 
 
@@ -26,10 +37,932 @@ def make_geo(df: pd.DataFrame) -> geopandas.GeoDataFrame:
     return gdf
 
 
+@functools.lru_cache(maxsize=None)
+def transformer(source: str, target: str) -> pyproj.Transformer:
+
+    """Return transformer between two crs, created once for every pair."""
+
+    return pyproj.Transformer.from_crs(source, target, always_xy=True)
+
+
+def project(x: np.ndarray, y: np.ndarray, source: str = "EPSG:5514",
+            target: str = "EPSG:3857") -> tuple:
+
+    """Return coordinates transformed from source to target crs at once.
+
+    Missing coordinates stay NaN.
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    px, py = transformer(source, target).transform(x, y)
+    missing = np.isnan(x) | np.isnan(y)
+    px[missing] = np.nan
+    py[missing] = np.nan
+    return px, py
+
+
+def web_mercator(gdf: geopandas.GeoDataFrame) -> tuple:
+
+    """Return x and y arrays of gdf points in EPSG:3857.
+
+    Points are transformed as coordinates, geometry is created later
+    only for the points that are plotted.
+    """
+
+    return project(
+        gdf.geometry.x.to_numpy(), gdf.geometry.y.to_numpy(),
+        gdf.crs.to_string(), "EPSG:3857")
+
+
+def projected_coordinates(region: str, downloader: DataDownloader = None,
+                          target: str = "EPSG:3857") -> tuple:
+
+    """Return d and e of region transformed to target crs.
+
+    Arrays are aligned with rows of to_dataframe([region]) and saved
+    next to the region cache, they are transformed again only if data
+    of the region changed since.
+    """
+
+    def load(path):
+        with np.load(path, allow_pickle=False) as saved:
+            return (saved["x"], saved["y"]), str(saved["fingerprint"])
+
+    def build():
+        data = downloader.get_list([region], columns=["d", "e"])
+        return project(data[1][0], data[1][1], "EPSG:5514", target)
+
+    def save(path, coordinates, fingerprint):
+        save_npz(path, x=coordinates[0], y=coordinates[1],
+                 fingerprint=np.array(fingerprint))
+
+    if downloader is None:
+        downloader = DataDownloader()
+    return region_file(region, downloader, target.replace(":", "").lower(),
+                       load, build, save)
+
+
+def save_npz(path: str, **arrays):
+
+    """Save arrays to .npz file through a temporary file.
+
+    File is replaced at once, so it's never read incomplete.
+    """
+
+    temporary = "{}.{}.tmp.npz".format(path, os.getpid())
+    np.savez(temporary, **arrays)
+    os.replace(temporary, path)
+
+
+def region_file(region: str, downloader: DataDownloader, suffix: str,
+                load, build, save):
+
+    """Return data of region kept in .npz file next to its cache.
+
+    Data are built and saved again if the file is missing, unreadable
+    or data of the region changed since it was saved.
+
+    Keyword arguments:
+    region -- region of the data
+    downloader -- DataDownloader with region data
+    suffix -- part of file name between name of the cache and .npz
+    load -- function returning data and fingerprint saved to path
+    build -- function returning data built from region data
+    save -- function saving data and fingerprint to path
+    """
+
+    path = "{}/{}.{}.npz".format(
+        downloader.folder, downloader.cache_filename.format(region), suffix)
+    try:
+        data, fingerprint = load(path)
+        if fingerprint == downloader.fingerprint([region]):
+            return data
+    except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+        pass
+
+    data = build()
+    save(path, data, downloader.fingerprint([region]))
+    return data
+
+
+class GridIndex:
+
+    """Uniform grid over S-JTSK (EPSG:5514) coordinates of accidents.
+
+    Points are sorted by their cell, so every row of cells is one slice
+    of the sorted arrays and queries only test points of cells they touch.
+    Queries return row labels of to_dataframe([region]) of the region.
+    """
+
+    # average number of points in a cell when cell size isn't given
+    points_per_cell = 16
+
+    def __init__(self, x: np.ndarray, y: np.ndarray,
+                 rows: np.ndarray = None, cell_size: float = None):
+
+        """Build index of points, rows are labels returned by queries.
+
+        Keyword arguments:
+        x, y -- coordinates, points with a missing one are left out
+        rows -- labels of points, their positions if not given
+        cell_size -- side of a cell, chosen from density of points if not given
+        """
+
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if rows is None:
+            rows = np.arange(len(x))
+        valid = ~(np.isnan(x) | np.isnan(y))
+        x, y, rows = x[valid], y[valid], np.asarray(rows)[valid]
+
+        self.x0, self.y0 = (x.min(), y.min()) if len(x) else (0.0, 0.0)
+        width = x.max() - self.x0 if len(x) else 0.0
+        height = y.max() - self.y0 if len(x) else 0.0
+        if cell_size is None:
+            cell_size = np.sqrt(
+                width * height * GridIndex.points_per_cell / max(len(x), 1))
+            # too many cells for points on a line or far from each other
+            cell_size = max(cell_size, max(width, height) / 4096, 1.0)
+        self.cell = float(cell_size)
+        self.nx = int(width // self.cell) + 1
+        self.ny = int(height // self.cell) + 1
+
+        # sort points by cell, offsets[c]:offsets[c + 1] are points of cell c
+        cells = self.cell_of(x, y)
+        order = np.argsort(cells, kind="stable")
+        self.x, self.y, self.rows = x[order], y[order], rows[order]
+        self.offsets = np.searchsorted(
+            cells[order], np.arange(self.nx * self.ny + 1))
+
+    def cell_of(self, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+
+        """Return number of cell of each point inside the grid."""
+
+        ix = ((x - self.x0) // self.cell).astype(np.int64)
+        iy = ((y - self.y0) // self.cell).astype(np.int64)
+        return iy * self.nx + ix
+
+    def candidates(self, xmin: float, ymin: float,
+                   xmax: float, ymax: float) -> np.ndarray:
+
+        """Return positions of points in cells touching given bounding box."""
+
+        ix0 = max(int((xmin - self.x0) // self.cell), 0)
+        iy0 = max(int((ymin - self.y0) // self.cell), 0)
+        ix1 = min(int((xmax - self.x0) // self.cell), self.nx - 1)
+        iy1 = min(int((ymax - self.y0) // self.cell), self.ny - 1)
+        if ix0 > ix1 or iy0 > iy1:
+            return np.empty(0, dtype=np.int64)
+
+        # one slice of sorted points for every row of cells
+        first = np.arange(iy0, iy1 + 1) * self.nx
+        starts = self.offsets[first + ix0]
+        lengths = self.offsets[first + ix1 + 1] - starts
+        shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return shift + np.arange(lengths.sum())
+
+    def bbox(self, xmin: float, ymin: float,
+             xmax: float, ymax: float) -> np.ndarray:
+
+        """Return sorted labels of points inside bounding box."""
+
+        found = self.candidates(xmin, ymin, xmax, ymax)
+        x, y = self.x[found], self.y[found]
+        inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+        return np.sort(self.rows[found[inside]])
+
+    def radius(self, x: float, y: float, r: float) -> np.ndarray:
+
+        """Return sorted labels of points at most r from point x, y."""
+
+        found = self.candidates(x - r, y - r, x + r, y + r)
+        inside = (self.x[found] - x)**2 + (self.y[found] - y)**2 <= r * r
+        return np.sort(self.rows[found[inside]])
+
+    def nearest(self, x: float, y: float, k: int = 1) -> np.ndarray:
+
+        """Return labels of k points nearest to point x, y, nearest first."""
+
+        if k <= 0:
+            return self.rows[:0]
+
+        # grow searched square until it holds k points closer than half side
+        half = self.cell
+        while True:
+            found = self.candidates(x - half, y - half, x + half, y + half)
+            distance = (self.x[found] - x)**2 + (self.y[found] - y)**2
+            covered = (
+                x - half <= self.x0
+                and x + half >= self.x0 + self.nx * self.cell
+                and y - half <= self.y0
+                and y + half >= self.y0 + self.ny * self.cell)
+            if len(found) >= k:
+                nearest = np.argpartition(distance, k - 1)[:k]
+                if distance[nearest].max() <= half * half or covered:
+                    break
+            elif covered:
+                nearest = np.arange(len(found))
+                break
+            half *= 2
+
+        nearest = nearest[np.argsort(distance[nearest], kind="stable")]
+        return self.rows[found[nearest]]
+
+    def save(self, path: str, fingerprint: str = ""):
+
+        """Save index to .npz file with fingerprint of its data."""
+
+        save_npz(
+            path, x=self.x, y=self.y, rows=self.rows, offsets=self.offsets,
+            grid=np.array([self.x0, self.y0, self.cell, self.nx, self.ny]),
+            fingerprint=np.array(fingerprint))
+
+    @classmethod
+    def load(cls, path: str):
+
+        """Return index saved to path and fingerprint of its data."""
+
+        with np.load(path, allow_pickle=False) as saved:
+            index = cls.__new__(cls)
+            index.x, index.y = saved["x"], saved["y"]
+            index.rows, index.offsets = saved["rows"], saved["offsets"]
+            index.x0, index.y0, index.cell, nx, ny = saved["grid"].tolist()
+            index.nx, index.ny = int(nx), int(ny)
+            return index, str(saved["fingerprint"])
+
+    @classmethod
+    def for_region(cls, region: str, downloader: DataDownloader = None):
+
+        """Return index of region saved next to its cache.
+
+        Index is built from d and e columns and saved if it's missing
+        or data of the region changed since it was saved.
+        """
+
+        def build():
+            data = downloader.get_list([region], columns=["d", "e"])
+            return cls(data[1][0], data[1][1])
+
+        if downloader is None:
+            downloader = DataDownloader()
+        return region_file(region, downloader, "grid", cls.load, build,
+                           lambda path, index, fingerprint:
+                           index.save(path, fingerprint))
+
+
+def inliers(x: np.ndarray, y: np.ndarray, quantile: float = 0.001,
+            margin: float = 0.1) -> np.ndarray:
+
+    """Return mask of points that aren't far outside of the others.
+
+    Points are kept if they lie between the quantile and 1 - quantile
+    of coordinates, widened on both sides by margin of that range.
+    """
+
+    keep = ~(np.isnan(x) | np.isnan(y))
+    for values in (x, y):
+        if not keep.any():
+            break
+        low, high = np.quantile(values[keep], [quantile, 1 - quantile])
+        spread = (high - low) * margin
+        keep &= (values >= low - spread) & (values <= high + spread)
+    return keep
+
+
+def cluster_points(x: np.ndarray, y: np.ndarray, method: str = "kmeans",
+                   n_clusters: int = 20, cell_size: float = 1000.0,
+                   min_points: int = 20, seed: int = 0) -> np.ndarray:
+
+    """Return cluster of every point, -1 for points in no cluster.
+
+    Keyword arguments:
+    x, y -- coordinates of points without missing values
+    method -- "kmeans" for MiniBatchKMeans or "density" for hotspots,
+              connected grid cells with at least min_points points each
+    n_clusters -- number of clusters of kmeans
+    cell_size -- side of a grid cell of density clustering
+    min_points -- number of points making a cell dense
+    seed -- random state of kmeans
+    """
+
+    if len(x) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if method == "kmeans":
+        model = sklearn.cluster.MiniBatchKMeans(
+            n_clusters=min(n_clusters, len(x)), random_state=seed)
+        return model.fit(np.column_stack([x, y])).labels_.astype(np.int64)
+
+    if method != "density":
+        raise ValueError("Unknown clustering method {}".format(method))
+
+    # count points in cells, border of empty cells keeps neighbours apart
+    ix = ((x - x.min()) // cell_size).astype(np.int64) + 1
+    iy = ((y - y.min()) // cell_size).astype(np.int64) + 1
+    width = ix.max() + 2
+    cells, inverse, counts = np.unique(
+        iy * width + ix, return_inverse=True, return_counts=True)
+    dense = cells[counts >= min_points]
+
+    # join neighbouring dense cells, each takes lowest label of its neighbours
+    first, second = list(), list()
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbours = dense + dy * width + dx
+            found = np.minimum(np.searchsorted(dense, neighbours),
+                               max(len(dense) - 1, 0))
+            adjacent = dense[found] == neighbours
+            first.append(np.flatnonzero(adjacent))
+            second.append(found[adjacent])
+    first, second = np.concatenate(first), np.concatenate(second)
+
+    labels = np.arange(len(dense))
+    while True:
+        joined = labels.copy()
+        np.minimum.at(joined, first, labels[second])
+        joined = joined[joined]
+        if np.array_equal(joined, labels):
+            break
+        labels = joined
+
+    cell_labels = np.full(len(cells), -1, dtype=np.int64)
+    cell_labels[counts >= min_points] = np.unique(
+        labels, return_inverse=True)[1]
+    return cell_labels[inverse.reshape(-1)]
+
+
+def summarize_clusters(x: np.ndarray, y: np.ndarray,
+                       labels: np.ndarray) -> pd.DataFrame:
+
+    """Return number of points (cnt) and centroid (x, y) of every cluster."""
+
+    clustered = labels >= 0
+    size = labels.max() + 1 if clustered.any() else 0
+    cnt = np.bincount(labels[clustered], minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cx = np.bincount(labels[clustered], x[clustered], size) / cnt
+        cy = np.bincount(labels[clustered], y[clustered], size) / cnt
+
+    clusters = pd.DataFrame(
+        {"cluster": np.arange(size), "cnt": cnt, "x": cx, "y": cy})
+    return clusters.loc[clusters["cnt"] > 0].reset_index(drop=True)
+
+
+def cluster_region(downloader: DataDownloader, region: str,
+                   method: str = "kmeans", **params) -> pd.DataFrame:
+
+    """Return clusters of accidents of region in EPSG:3857.
+
+    Coordinates are taken from projected_coordinates, points far outside
+    of the region are left out, params are passed to cluster_points.
+    """
+
+    x, y = projected_coordinates(region, downloader)
+    keep = inliers(x, y)
+    labels = cluster_points(x[keep], y[keep], method, **params)
+    clusters = summarize_clusters(x[keep], y[keep], labels)
+    clusters.insert(0, "region", region)
+    return clusters
+
+
+def cluster_region_task(folder: str, cache_filename: str, region: str,
+                        method: str, params: dict, cache: bool,
+                        offline: bool = True) -> pd.DataFrame:
+
+    """Cluster region in a worker process, through aggregate cache if cache.
+
+    Offline worker only reads caches and archives already downloaded.
+    """
+
+    downloader = DataDownloader(folder=folder, cache_filename=cache_filename,
+                                offline=offline)
+    if not cache:
+        return cluster_region(downloader, region, method, **params)
+    return AggregateCache(downloader, regions=[region]).get(
+        cluster_region, region, method=method, source="downloader", **params)
+
+
+def cluster_regions(regions: list = None, method: str = "kmeans",
+                    downloader: DataDownloader = None, workers: int = 1,
+                    cache: bool = True, **params) -> pd.DataFrame:
+
+    """Return clusters of accidents of each region, see cluster_region.
+
+    Keyword arguments:
+    regions -- list of regions, all of them if not given
+    method -- clustering method of cluster_points
+    downloader -- DataDownloader with region data
+    workers -- number of processes clustering regions in parallel
+    cache -- whether clusters are kept in AggregateCache, each region
+             is clustered again only if its data changed
+    params -- parameters of cluster_points
+    """
+
+    if downloader is None:
+        downloader = DataDownloader()
+    if regions is None:
+        regions = list(DataDownloader.region_match)
+    tasks = [(downloader.folder, downloader.cache_filename, region, method,
+              params, cache, downloader.offline) for region in regions]
+
+    if workers > 1 and len(regions) > 1:
+        # data are downloaded once here, workers only read them
+        if not downloader.offline:
+            try:
+                downloader.download_data()
+            except requests.RequestException as e:
+                print("Data couldn't be downloaded, using local copy: {}"
+                      .format(e), file=sys.stderr)
+        tasks = [task[:-1] + (True,) for task in tasks]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            clusters = list(pool.map(cluster_region_task, *zip(*tasks)))
+    else:
+        clusters = [cluster_region_task(*task) for task in tasks]
+
+    return pd.concat(clusters, ignore_index=True)
+
+
+class DensityPyramid:
+
+    """Numbers of accidents in square cells of Web Mercator grid.
+
+    Level 0 has cells of base size, every next level has cells twice
+    as big. Counts are kept for every year and p5a (1 in municipality,
+    2 outside of it), so maps of any part of them are drawn from cells
+    instead of points. Cells of all regions are aligned, so pyramids
+    of several regions can be combined.
+    """
+
+    # corner of Web Mercator grid, all cell numbers are positive
+    origin = -20037508.342789244
+
+    # bits of cell numbers in keys used for counting
+    cell_bits = 20
+
+    def __init__(self, level: np.ndarray, ix: np.ndarray, iy: np.ndarray,
+                 year: np.ndarray, p5a: np.ndarray, count: np.ndarray,
+                 base: float):
+
+        """Create pyramid from its table, one row per non-empty cell."""
+
+        self.level, self.ix, self.iy = level, ix, iy
+        self.year, self.p5a, self.count = year, p5a, count
+        self.base = base
+
+    @classmethod
+    def build(cls, x: np.ndarray, y: np.ndarray, dates: np.ndarray,
+              p5a: np.ndarray, base: float = 250.0, levels: int = 10):
+
+        """Count points in cells of all levels.
+
+        Keyword arguments:
+        x, y -- coordinates in EPSG:3857, missing ones are left out
+        dates -- datetime64 dates of accidents
+        p5a -- location of accidents (1 in municipality, 2 outside)
+        base -- side of a cell at level 0
+        levels -- number of levels
+        """
+
+        valid = ~(np.isnan(x) | np.isnan(y) | np.isnat(dates))
+        ix = ((x[valid] - cls.origin) // base).astype(np.int64)
+        iy = ((y[valid] - cls.origin) // base).astype(np.int64)
+        year = dates[valid].astype("datetime64[Y]").astype(np.int64) + 1970
+        counts = np.ones(len(ix), dtype=np.int64)
+        p5a = np.asarray(p5a)[valid].astype(np.int64)
+
+        # every level is counted from cells of the previous one
+        table = list()
+        for level in range(levels):
+            keys, inverse = np.unique(
+                cls.key(ix, iy, year, p5a), return_inverse=True)
+            counts = np.bincount(inverse.reshape(-1), counts, len(keys))
+            ix, iy, year, p5a = cls.unkey(keys)
+            counts = counts.astype(np.int64)
+            table.append((np.full(len(keys), level), ix, iy, year, p5a,
+                          counts))
+            ix, iy = ix >> 1, iy >> 1
+
+        columns = [np.concatenate(column) for column in zip(*table)] \
+            if table else [np.empty(0, dtype=np.int64)] * 6
+        return cls(*columns, base)
+
+    @classmethod
+    def key(cls, ix: np.ndarray, iy: np.ndarray, year: np.ndarray,
+            p5a: np.ndarray) -> np.ndarray:
+
+        """Return one integer made of cell, year and p5a of each row."""
+
+        key = ix << cls.cell_bits | iy
+        key = key << 8 | (year - 1970)
+        return key << 8 | (p5a & 0xff)
+
+    @classmethod
+    def unkey(cls, key: np.ndarray) -> tuple:
+
+        """Return cell, year and p5a from integers made by key."""
+
+        p5a = (key & 0xff).astype(np.int8).astype(np.int64)
+        year = (key >> 8 & 0xff) + 1970
+        iy = key >> 16 & (1 << cls.cell_bits) - 1
+        ix = key >> 16 + cls.cell_bits
+        return ix, iy, year, p5a
+
+    @classmethod
+    def combine(cls, pyramids: list):
+
+        """Return pyramid with counts of all pyramids summed."""
+
+        columns = [np.concatenate(column) for column in zip(
+            *[(p.level, p.ix, p.iy, p.year, p.p5a, p.count)
+              for p in pyramids])]
+        keys, inverse = np.unique(
+            np.column_stack(columns[:5]), axis=0, return_inverse=True)
+        count = np.bincount(inverse.reshape(-1), columns[5], len(keys))
+        return cls(*keys.T, count.astype(np.int64), pyramids[0].base)
+
+    def cell_size(self, level: int) -> float:
+
+        """Return side of a cell at level."""
+
+        return self.base * 2 ** level
+
+    def level_for(self, width: float, height: float,
+                  max_cells: int = 4096) -> int:
+
+        """Return finest level with at most max_cells cells in area."""
+
+        for level in range(self.level.max() + 1 if len(self.level) else 0):
+            size = self.cell_size(level)
+            if np.ceil(width / size) * np.ceil(height / size) <= max_cells:
+                return level
+        return int(self.level.max()) if len(self.level) else 0
+
+    def cells(self, level: int, years: list = None,
+              p5a: list = None) -> pd.DataFrame:
+
+        """Return centers (x, y) and counts of cells at level.
+
+        Only accidents in given years and with given p5a are counted,
+        all of them if not given.
+        """
+
+        selected = self.level == level
+        if years is not None:
+            selected &= np.isin(self.year, list(years))
+        if p5a is not None:
+            selected &= np.isin(self.p5a, list(p5a))
+
+        keys, inverse = np.unique(
+            self.ix[selected] << self.cell_bits | self.iy[selected],
+            return_inverse=True)
+        count = np.bincount(
+            inverse.reshape(-1), self.count[selected], len(keys))
+        size = self.cell_size(level)
+        return pd.DataFrame({
+            "x": self.origin + ((keys >> self.cell_bits) + 0.5) * size,
+            "y": self.origin + ((keys & (1 << self.cell_bits) - 1) + 0.5)
+            * size,
+            "count": count.astype(np.int64)})
+
+    def raster(self, level: int, years: list = None, p5a: list = None,
+               bounds: tuple = None) -> tuple:
+
+        """Return 2D array of counts at level and its extent.
+
+        Array covers bounds (x1, y1, x2, y2) or all cells if not given,
+        rows go from south to north as for imshow with origin="lower".
+        """
+
+        cells = self.cells(level, years, p5a)
+        size = self.cell_size(level)
+        if bounds is None:
+            bounds = (cells["x"].min(), cells["y"].min(),
+                      cells["x"].max(), cells["y"].max()) \
+                if len(cells) else (0.0, 0.0, 0.0, 0.0)
+        # cells are aligned to origin, not to 0
+        ix0 = int((bounds[0] - self.origin) // size)
+        iy0 = int((bounds[1] - self.origin) // size)
+        nx = int((bounds[2] - self.origin) // size) - ix0 + 1
+        ny = int((bounds[3] - self.origin) // size) - iy0 + 1
+
+        ix = ((cells["x"].to_numpy() - self.origin) // size).astype(
+            np.int64) - ix0
+        iy = ((cells["y"].to_numpy() - self.origin) // size).astype(
+            np.int64) - iy0
+        inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+        image = np.bincount(
+            iy[inside] * nx + ix[inside],
+            cells["count"].to_numpy()[inside], nx * ny).reshape(ny, nx)
+        extent = (self.origin + ix0 * size, self.origin + (ix0 + nx) * size,
+                  self.origin + iy0 * size, self.origin + (iy0 + ny) * size)
+        return image, extent
+
+    def save(self, path: str, fingerprint: str = ""):
+
+        """Save pyramid to .npz file with fingerprint of its data."""
+
+        save_npz(
+            path, level=self.level, ix=self.ix, iy=self.iy, year=self.year,
+            p5a=self.p5a, count=self.count, base=np.array(self.base),
+            fingerprint=np.array(fingerprint))
+
+    @classmethod
+    def load(cls, path: str) -> tuple:
+
+        """Return pyramid saved to path and fingerprint of its data."""
+
+        with np.load(path, allow_pickle=False) as saved:
+            pyramid = cls(
+                saved["level"], saved["ix"], saved["iy"], saved["year"],
+                saved["p5a"], saved["count"], float(saved["base"]))
+            return pyramid, str(saved["fingerprint"])
+
+    @classmethod
+    def for_region(cls, region: str, downloader: DataDownloader = None):
+
+        """Return pyramid of region saved next to its cache.
+
+        Pyramid is built and saved if it's missing or data of the region
+        changed since it was saved.
+        """
+
+        def build():
+            x, y = projected_coordinates(region, downloader)
+            data = downloader.get_list([region], columns=["p2a", "p5a"])
+            return cls.build(x, y, data[1][0], data[1][1])
+
+        if downloader is None:
+            downloader = DataDownloader()
+        return region_file(region, downloader, "pyramid", cls.load, build,
+                           lambda path, pyramid, fingerprint:
+                           pyramid.save(path, fingerprint))
+
+
+class TileCache:
+
+    """Basemap tiles kept on disk as {z}/{x}/{y} files.
+
+    Tiles missing in the folder are downloaded from source, least recently
+    used ones are removed once the folder grows over max_size bytes.
+    In offline mode only tiles already in the folder are used, missing
+    ones are left blank.
+    """
+
+    # half of the side of Web Mercator world
+    extent = 20037508.342789244
+
+    # lon/lat bounding box of Czechia
+    czech_bounds = (12.09, 48.55, 18.86, 51.06)
+
+    headers = {"User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+               "AppleWebKit/605.1.15 (KHTML, like Gecko) "
+               "Version/14.0 Safari/605.1.15"}
+
+    def __init__(self, source=None, folder: str = None,
+                 max_size: int = 512 * 2**20, offline: bool = False,
+                 workers: int = 4):
+
+        """Create cache of tiles of source.
+
+        Keyword arguments:
+        source -- contextily provider or URL with {x}, {y} and {z},
+                  Stamen TonerLite if not given
+        folder -- folder with tiles, data/tiles/<provider name> if not given
+        max_size -- maximum size of folder in bytes
+        offline -- whether only tiles already in folder are used
+        workers -- number of threads downloading tiles
+        """
+
+        self.source = source if source is not None \
+            else ctx.providers.Stamen.TonerLite
+        if folder is None:
+            folder = "data/tiles/" + getattr(self.source, "name", "custom")
+        self.folder = folder
+        self.max_size = max_size
+        self.offline = offline
+        self.workers = workers
+
+        # counters of tiles looked up since creation
+        self.hits = 0
+        self.misses = 0
+        self.downloaded = 0
+
+        # shared by all threads of warm, connections are limited to workers
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def url(self, x: int, y: int, z: int) -> str:
+
+        """Return URL of tile in source."""
+
+        if isinstance(self.source, str):
+            return self.source.format(x=x, y=y, z=z)
+        return self.source.build_url(x=x, y=y, z=z)
+
+    def path(self, x: int, y: int, z: int) -> str:
+
+        """Return path of tile in folder."""
+
+        return "{}/{}/{}/{}.png".format(self.folder, z, x, y)
+
+    def max_zoom(self) -> int:
+
+        """Return highest zoom of source."""
+
+        return self.source.get("max_zoom", 19) \
+            if hasattr(self.source, "get") else 19
+
+    def tiles(self, bounds: tuple, z: int) -> tuple:
+
+        """Return ranges of tile columns and rows covering EPSG:3857 bounds."""
+
+        size = 2 * self.extent / 2 ** z
+        last = 2 ** z - 1
+        x1 = min(max(int((bounds[0] + self.extent) // size), 0), last)
+        x2 = min(max(int((bounds[2] + self.extent) // size), 0), last)
+        y1 = min(max(int((self.extent - bounds[3]) // size), 0), last)
+        y2 = min(max(int((self.extent - bounds[1]) // size), 0), last)
+        return range(x1, x2 + 1), range(y1, y2 + 1)
+
+    def zoom_for(self, bounds: tuple, max_tiles: int = 64) -> int:
+
+        """Return highest zoom with at most max_tiles tiles in bounds."""
+
+        for z in range(self.max_zoom(), -1, -1):
+            xs, ys = self.tiles(bounds, z)
+            if len(xs) * len(ys) <= max_tiles:
+                return z
+        return 0
+
+    def tile(self, x: int, y: int, z: int) -> np.ndarray:
+
+        """Return RGBA image of tile, None if it isn't available."""
+
+        path = self.path(x, y, z)
+        if os.path.exists(path):
+            self.hits += 1
+            instrument.count("tile_cache_hits")
+            # mark tile as recently used
+            if not self.offline:
+                os.utime(path)
+        else:
+            self.misses += 1
+            instrument.count("tile_cache_misses")
+            if self.offline or not self.fetch(x, y, z):
+                return None
+
+        image = plt.imread(path)
+        if image.dtype == np.uint8:
+            image = image.astype(np.float32) / 255
+        if image.ndim == 2:
+            image = np.dstack([image] * 3)
+        if image.shape[2] == 3:
+            image = np.dstack([image, np.ones(image.shape[:2], image.dtype)])
+        return image
+
+    def fetch(self, x: int, y: int, z: int) -> bool:
+
+        """Download tile to folder, return whether it succeeded."""
+
+        path = self.path(x, y, z)
+        try:
+            r = self.session.get(
+                self.url(x, y, z), headers=TileCache.headers, timeout=30)
+            r.raise_for_status()
+        except requests.RequestException as e:
+            print("Tile {}/{}/{} couldn't be downloaded: {}".format(
+                z, x, y, e), file=sys.stderr)
+            return False
+
+        # written through temporary file so it's never read incomplete
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(r.content)
+        os.replace(path + ".tmp", path)
+        self.downloaded += 1
+        instrument.count("tile_bytes_downloaded", len(r.content))
+        return True
+
+    def warm(self, bounds: tuple = None, zooms: range = range(5, 11)) -> int:
+
+        """Download missing tiles of lon/lat bounds at zooms.
+
+        Bounds are Czechia if not given, returns number of downloaded tiles.
+        """
+
+        if self.offline:
+            return 0
+        bounds = self.mercator(bounds if bounds is not None
+                               else TileCache.czech_bounds)
+        missing = [(x, y, z) for z in zooms
+                   for x in self.tiles(bounds, z)[0]
+                   for y in self.tiles(bounds, z)[1]
+                   if not os.path.exists(self.path(x, y, z))]
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            done = sum(pool.map(lambda tile: self.fetch(*tile), missing))
+        self.evict()
+        return done
+
+    @classmethod
+    def mercator(cls, bounds: tuple) -> tuple:
+
+        """Return lon/lat bounds in EPSG:3857."""
+
+        x1, y1, x2, y2 = np.radians(bounds)
+        radius = cls.extent / np.pi
+        return (x1 * radius, np.log(np.tan(np.pi / 4 + y1 / 2)) * radius,
+                x2 * radius, np.log(np.tan(np.pi / 4 + y2 / 2)) * radius)
+
+    def add_basemap(self, ax, zoom: int = None, max_tiles: int = 64):
+
+        """Draw tiles under the current extent of ax in EPSG:3857.
+
+        Zoom is the highest one with at most max_tiles tiles if not given,
+        in offline mode the highest one of those in folder.
+        """
+
+        x1, x2 = ax.get_xlim()
+        y1, y2 = ax.get_ylim()
+        bounds = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        if zoom is None:
+            zoom = self.zoom_for(bounds, max_tiles)
+            # offline folder may have only some of the zooms
+            while self.offline and zoom > 0 and not os.path.isdir(
+                    "{}/{}".format(self.folder, zoom)):
+                zoom -= 1
+        xs, ys = self.tiles(bounds, zoom)
+
+        # join tiles to one image, tiles that aren't available stay blank
+        images = [[self.tile(x, y, zoom) for x in xs] for y in ys]
+        size = next((image.shape[0] for row in images for image in row
+                     if image is not None), 256)
+        mosaic = np.zeros((len(ys) * size, len(xs) * size, 4), np.float32)
+        for row, line in enumerate(images):
+            for col, image in enumerate(line):
+                if image is not None and image.shape[0] == size:
+                    mosaic[row * size:(row + 1) * size,
+                           col * size:(col + 1) * size] = image
+        self.evict()
+
+        side = 2 * self.extent / 2 ** zoom
+        ax.imshow(
+            mosaic, interpolation="bilinear", zorder=0,
+            extent=(xs[0] * side - self.extent,
+                    (xs[-1] + 1) * side - self.extent,
+                    self.extent - (ys[-1] + 1) * side,
+                    self.extent - ys[0] * side))
+        ax.axis((x1, x2, y1, y2))
+
+        attribution = getattr(self.source, "attribution", None)
+        if attribution:
+            ctx.add_attribution(ax, attribution)
+
+    def evict(self):
+
+        """Remove least recently used tiles over max_size of folder."""
+
+        if self.offline or not os.path.exists(self.folder):
+            return
+        evict_lru([os.path.join(root, name)
+                   for root, _, files in os.walk(self.folder)
+                   for name in files], self.max_size)
+
+    def stats(self) -> dict:
+
+        """Return numbers of hits, misses, downloaded tiles and hit rate."""
+
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses,
+                "downloaded": self.downloaded,
+                "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+def add_basemap(ax, tiles: TileCache = None):
+
+    """Add TonerLite basemap to ax in EPSG:3857.
+
+    Tiles are taken from tiles if given, contextily fetches them otherwise.
+    """
+
+    if tiles is not None:
+        tiles.add_basemap(ax)
+    else:
+        ctx.add_basemap(
+            ax,
+            crs="EPSG:3857",
+            source=ctx.providers.Stamen.TonerLite)
+
+
 def plot_geo(
         gdf: geopandas.GeoDataFrame,
         fig_location: str = None,
-        show_figure: bool = False):
+        show_figure: bool = False,
+        tiles: TileCache = None):
 
     """Plot geographical data of accidents in a chosen region (JHM).
 
@@ -37,20 +970,26 @@ def plot_geo(
     gdf -- GeoDataFrame with data needed for plotting
     fig_location -- location saying where to store the plotted figure
     show_figure -- whether the plotted figure is shown
+    tiles -- TileCache with basemap, fetched by contextily if not given
     """
 
     # change crs to get a less blurry map
-    gdf = gdf.to_crs("epsg:3857")
+    x, y = web_mercator(gdf)
+    crs = "EPSG:3857"
 
-    # prep 2 geo data frames for 2 subplots
-    vob = gdf.loc[gdf["p5a"] == 1]
-    nob = gdf.loc[gdf["p5a"] == 2]
+    # prep 2 geo series for 2 subplots
+    inside = (gdf["p5a"] == 1).to_numpy()
+    outside = (gdf["p5a"] == 2).to_numpy()
+    vob = geopandas.GeoSeries(
+        geopandas.points_from_xy(x[inside], y[inside]), crs=crs)
+    nob = geopandas.GeoSeries(
+        geopandas.points_from_xy(x[outside], y[outside]), crs=crs)
 
     # plotting
     _, ax = plt.subplots(1, 2, figsize=(13, 8))
 
     # setting boundaries for subplots to be the same for a prettier result
-    x1, y1, x2, y2 = gdf.geometry.total_bounds
+    x1, y1, x2, y2 = np.nanmin(x), np.nanmin(y), np.nanmax(x), np.nanmax(y)
 
     ax[0].set_xlim(x1 + (x2-x1)/5.5, x2)
     ax[0].set_ylim(y1 - (y2-y1)/50, y2)
@@ -60,16 +999,10 @@ def plot_geo(
 
     # creating subplots and setting params for them
     vob.plot(markersize=0.5, ax=ax[1])
-    ctx.add_basemap(
-        ax[1],
-        crs=gdf.crs.to_string(),
-        source=ctx.providers.Stamen.TonerLite)
+    add_basemap(ax[1], tiles)
 
     nob.plot(markersize=0.5, ax=ax[0], color="r")
-    ctx.add_basemap(
-        ax[0],
-        crs=gdf.crs.to_string(),
-        source=ctx.providers.Stamen.TonerLite)
+    add_basemap(ax[0], tiles)
 
     for col in ax:
         col.set_xticks([])
@@ -91,42 +1024,32 @@ def plot_geo(
 def plot_cluster(
         gdf: geopandas.GeoDataFrame,
         fig_location: str = None,
-        show_figure: bool = False):
+        show_figure: bool = False,
+        method: str = "kmeans",
+        tiles: TileCache = None):
 
     """Plot clustered accident data.
 
     Keyword arguments:
     gdf -- GeoDataFrame with data needed for plotting
     fig_location -- location saying where to store the plotted figure
-    show_figure -- whether the plotted figure is shown"""
-
-    # drop one accident that is far outside of the region
-    # and is messing with clustering
-    gdf = gdf.drop(gdf[gdf.geometry.x < -700000].index)
-    gdf = gdf.to_crs("epsg:3857")
-
-    # cluster accident data
-    coords = np.dstack([gdf.geometry.x, gdf.geometry.y]).reshape(-1, 2)
-    model = sklearn.cluster.MiniBatchKMeans(n_clusters=20).fit(coords)
-
-    # add column to identify clusters
-    gdf_clstrd = gdf.copy()
-    gdf_clstrd["cluster"] = model.labels_
+    show_figure -- whether the plotted figure is shown
+    method -- clustering method of cluster_points
+    tiles -- TileCache with basemap, fetched by contextily if not given"""
 
-    # aggregate to get count of accidents in each cluster
-    gdf_clstrd = gdf_clstrd.dissolve(
-        by="cluster",
-        aggfunc={"p1": "count"}).rename(columns={"p1": "cnt"})
+    # drop accidents that are far outside of the region
+    # and are messing with clustering
+    x, y = web_mercator(gdf)
+    keep = inliers(x, y)
+    x, y = x[keep], y[keep]
+    crs = "EPSG:3857"
 
-    # get center points from cluster polygons
-    gdf_coords = geopandas.GeoDataFrame(
-        geometry=geopandas.points_from_xy(
-            model.cluster_centers_[:, 0],
-            model.cluster_centers_[:, 1]))
-    gdf_clstrd = gdf_clstrd.merge(
-        gdf_coords,
-        left_on="cluster",
-        right_index=True).set_geometry("geometry_y")
+    # cluster accident data, count and center of each cluster
+    clusters = summarize_clusters(x, y, cluster_points(x, y, method))
+    gdf_clstrd = geopandas.GeoDataFrame(
+        clusters,
+        geometry=geopandas.points_from_xy(clusters["x"], clusters["y"]),
+        crs=crs)
 
     # plotting
     plt.figure(figsize=(13, 8))
@@ -134,7 +1057,8 @@ def plot_cluster(
 
     # 2 plots; first one for clusters and second one for all accidents
 
-    gdf.plot(ax=ax, color="grey", markersize=0.1)
+    geopandas.GeoSeries(geopandas.points_from_xy(x, y), crs=crs).plot(
+        ax=ax, color="grey", markersize=0.1)
     gdf_clstrd.plot(
         ax=ax,
         markersize=gdf_clstrd["cnt"] / 10,
@@ -143,10 +1067,7 @@ def plot_cluster(
         legend=True)
 
     # add map
-    ctx.add_basemap(
-        ax,
-        crs=gdf.crs.to_string(),
-        source=ctx.providers.Stamen.TonerLite)
+    add_basemap(ax, tiles)
 
     # set params for the plot
     ax.set_xticks([])
@@ -162,8 +1083,67 @@ def plot_cluster(
         plt.show()
 
 
+def plot_density(
+        regions: list = None,
+        fig_location: str = None,
+        show_figure: bool = False,
+        years: list = None,
+        max_cells: int = 4096,
+        tiles: TileCache = None):
+
+    """Plot density of accidents in regions from their pyramids.
+
+    Keyword arguments:
+    regions -- list of regions, JHM if not given
+    fig_location -- location saying where to store the plotted figure
+    show_figure -- whether the plotted figure is shown
+    years -- years of accidents, all of them if not given
+    max_cells -- maximum number of cells in each subplot
+    tiles -- TileCache with basemap, fetched by contextily if not given
+    """
+
+    if regions is None:
+        regions = ["JHM"]
+    downloader = DataDownloader()
+    pyramid = DensityPyramid.combine(
+        [DensityPyramid.for_region(region, downloader) for region in regions])
+
+    # the finest level drawing whole area from at most max_cells cells
+    cells = pyramid.cells(0, years)
+    bounds = (cells["x"].min(), cells["y"].min(),
+              cells["x"].max(), cells["y"].max())
+    level = pyramid.level_for(
+        bounds[2] - bounds[0], bounds[3] - bounds[1], max_cells)
+
+    _, ax = plt.subplots(1, 2, figsize=(13, 8))
+
+    for col, p5a, title in zip(ax, (2, 1), ("mimo obec", "v obci")):
+        image, extent = pyramid.raster(level, years, [p5a], bounds)
+        col.imshow(
+            np.ma.masked_equal(image, 0), extent=extent, origin="lower",
+            norm=matplotlib.colors.LogNorm(), alpha=0.7)
+        add_basemap(col, tiles)
+        col.set_xticks([])
+        col.set_yticks([])
+        col.title.set_text(
+            "Nehody {} [{}]".format(title, ", ".join(regions)))
+
+    plt.tight_layout()
+
+    # checking whather to save and show the plot
+    if fig_location is not None:
+        plt.savefig(fig_location)
+
+    if show_figure:
+        plt.show()
+
+
 if __name__ == "__main__":
     # zde muzete delat libovolne modifikace
-    gdf = make_geo(pd.read_pickle("accidents.pkl.gz"))
+    gdf = make_geo(DataDownloader().to_dataframe(["JHM"]))
     # plot_geo(gdf, "geo1.png", True)
     # plot_cluster(gdf, "geo2.png", True)
+    # plot_density(["JHM"], "geo3.png", True)
+    # tiles = TileCache()
+    # tiles.warm()
+    # plot_geo(gdf, "geo1.png", True, TileCache(offline=True))
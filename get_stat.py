@@ -1,12 +1,29 @@
-from download import DataDownloader
+from aggregates import AggregateCache, aggregate
 import matplotlib.pyplot as plt
-import os, sys, argparse, collections
+import numpy as np
+import os, sys, argparse
 
-#create parser for args from command line
-parser = argparse.ArgumentParser(description="Get plot of the number of accidents in all of the regions in Czechia")
-parser.add_argument('--fig_location',type=str,metavar='directory', default=None)
-parser.add_argument('--show_figure', type=bool,metavar='(True/False)', default=False)
-args = parser.parse_args()
+def count_accidents(data_source):
+
+    #number of accidents of each region (rows) in each year (columns) as ndarray,
+    #returned with region names in order of their first appearance and sorted years
+    dates = data_source[1][data_source[0].index("p2a")]
+    regions = data_source[1][data_source[0].index("p99")]
+
+    #region codes, encoded column already has them
+    if hasattr(regions, "categories"):
+        names, codes = regions.categories, regions.codes.astype(np.int64)
+    else:
+        names, codes = np.unique(regions, return_inverse=True)
+
+    valid = ~np.isnat(dates)
+    years, year_index = np.unique(dates[valid].astype("datetime64[Y]").astype(np.int64) + 1970, return_inverse=True)
+    counts = np.bincount(codes[valid] * len(years) + year_index, minlength=len(names) * len(years)).reshape(len(names), len(years))
+
+    #keep only regions present in data, in order of first appearance
+    present, first = np.unique(codes, return_index=True)
+    order = present[np.argsort(first)]
+    return names[order], years, counts[order]
 
 def plot_stat(data_source, fig_location = None, show_figure = False):
 
@@ -19,59 +36,36 @@ def plot_stat(data_source, fig_location = None, show_figure = False):
                 print("{} is an invalid path and directory couldn't be created".format(fig_location), file=sys.stderr)
                 exit(-1)
 
-    #save relevant data for plotting into nested dict
-    regions = dict()
-    
-    for date, region in zip(data_source[1][3], data_source[1][-1]):
-        if region not in regions:
-            regions[region] = dict()
-        if str(date.astype(object).year) not in regions[region]:
-            
-            regions[region][str(date.astype(object).year)] = 1
-        else:
-            
-            regions[region][str(date.astype(object).year)] += 1
+    #count accidents of each region in each year, data_source can be AggregateCache holding the counts
+    x, years, counts = aggregate(data_source, count_accidents, source="list", columns=["p2a", "p99"])
     
     #plotting
 
     plt.style.use('fivethirtyeight')
     
-    x = list()
-    for region in regions:
-        x.append(region)
-    
     x_pos = [i for i, _ in enumerate(x)]
     
     _, ax = plt.subplots(nrows = 5, ncols=1, figsize=(6,8), sharey=True)
 
     #creating subplots
-    for col, year in zip(ax,sorted(list(list(regions.items())[2][1].keys()))):
-       
-        accident_values = list()
-        order = dict()
-        ordered = collections.OrderedDict()
+    for col, year, accident_values in zip(ax, years, counts.T):
 
         #get order for annotations
-        for region in x:
-            accident_values.append(regions[region][year])
-            order[region] = regions[region][year]
-        order = sorted(list(order.items()), key=lambda z:z[1], reverse=True)
-        
-        for i in order:
-            ordered[i[0]] = i[1]
+        order = np.empty(len(x), dtype=np.int64)
+        order[np.argsort(-accident_values, kind="stable")] = np.arange(len(x))
 
         #setting up parameters and appearance of subplot
         values = col.bar(x_pos, accident_values, width = 0.35)
-        col.set_title(year, fontsize = 11)
+        col.set_title(str(year), fontsize = 11)
         col.set_xticks(x_pos)
         col.set_xticklabels(x)
         col.tick_params(axis='x', labelsize=7)
         col.tick_params(axis='y', labelsize = 7)
-        col.grid(b=None, axis='x')
+        col.grid(None, axis='x')
 
         #annotations
-        for value,region in zip(values, regions):
-            col.annotate(str(list(ordered.keys()).index(region) + 1) + '.', xy=(value.get_x() + value.get_width() / 2, value.get_height()), xytext = (0,2), textcoords = "offset points", ha="center", fontsize=6)
+        for value, rank in zip(values, order):
+            col.annotate(str(rank + 1) + '.', xy=(value.get_x() + value.get_width() / 2, value.get_height()), xytext = (0,2), textcoords = "offset points", ha="center", fontsize=6)
     plt.tight_layout()
 
     #arg handling
@@ -83,6 +77,13 @@ def plot_stat(data_source, fig_location = None, show_figure = False):
 
 if __name__ == "__main__":
 
-    plot_stat(data_source = DataDownloader().get_list(),fig_location=args.fig_location, show_figure=args.show_figure)
+    #create parser for args from command line
+    parser = argparse.ArgumentParser(description="Get plot of the number of accidents in all of the regions in Czechia")
+    parser.add_argument('--fig_location',type=str,metavar='directory', default=None)
+    parser.add_argument('--show_figure', type=bool,metavar='(True/False)', default=False)
+    args = parser.parse_args()
+
+    #counts are computed from data only if they changed since the last run
+    plot_stat(data_source = AggregateCache(),fig_location=args.fig_location, show_figure=args.show_figure)
         
 
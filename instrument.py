@@ -0,0 +1,98 @@
+import os, sys, time, json, atexit, resource, cProfile, contextlib, functools, multiprocessing
+
+#measurements of pipeline stages, nothing is recorded until enable() is called,
+#by the entry point or by IZV_STATS / IZV_PROFILE environment variables holding paths of the JSON report
+#and of cProfile stats, only the main process records, stages run in worker processes aren't included
+
+enabled = False
+
+#stage name : {"calls", "seconds", "rows", "bytes"}
+stages = dict()
+
+#counter name : value
+counters = dict()
+
+class Stage:
+
+    #one pass through a stage, measured code adds rows and bytes it processed
+    def __init__(self):
+        self.rows = 0
+        self.bytes = 0
+
+@contextlib.contextmanager
+def stage(name):
+    #measure time of the block, rows and bytes are taken from the yielded Stage
+    record = Stage()
+    if not enabled:
+        yield record
+        return
+    start = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record_stage(name, time.perf_counter() - start, record.rows, record.bytes)
+
+def record_stage(name, seconds, rows = 0, bytes = 0):
+    #add pass through stage measured elsewhere, e.g. in a worker process
+    if not enabled:
+        return
+    total = stages.setdefault(name, {"calls" : 0, "seconds" : 0.0, "rows" : 0, "bytes" : 0})
+    total["calls"] += 1
+    total["seconds"] += seconds
+    total["rows"] += rows
+    total["bytes"] += bytes
+
+def timed(name):
+    #decorator measuring every call of function as stage name
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def count(name, value = 1):
+    if enabled:
+        counters[name] = counters.get(name, 0) + value
+
+def peak_rss():
+    #peak resident set size of the process and of its finished children in MiB
+    return {"self" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10,
+            "children" : resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 2**10}
+
+def report():
+    #measurements as dict ready for JSON, rates are per second of the stage
+    result = dict()
+    for name, total in stages.items():
+        result[name] = dict(total)
+        result[name]["rows_per_second"] = total["rows"] / total["seconds"] if total["seconds"] else 0.0
+        result[name]["bytes_per_second"] = total["bytes"] / total["seconds"] if total["seconds"] else 0.0
+    return {"argv" : sys.argv, "time" : time.time(), "stages" : result, "counters" : dict(counters), "peak_rss_mib" : peak_rss()}
+
+def dump(path):
+    #write report to path, "-" is stderr
+    if path == "-":
+        json.dump(report(), sys.stderr, indent=2)
+        print(file=sys.stderr)
+        return
+    with open(path + '.part', 'w') as f:
+        json.dump(report(), f, indent=2)
+    os.replace(path + '.part', path)
+
+def enable(path = None, profile = None):
+    #start recording, report is written to path and cProfile stats to profile at exit if given
+    global enabled
+    enabled = True
+    if path is not None:
+        atexit.register(dump, path)
+    if profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(profiler.dump_stats, profile)
+        atexit.register(profiler.disable)
+
+if multiprocessing.parent_process() is None and (os.environ.get("IZV_STATS") or os.environ.get("IZV_PROFILE")):
+    enable(os.environ.get("IZV_STATS"), os.environ.get("IZV_PROFILE"))
@@ -0,0 +1,117 @@
+import matplotlib
+#figures are only saved, workers never open a window
+matplotlib.use("Agg")
+
+from download import DataDownloader
+from aggregates import AggregateCache
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib.pyplot as plt
+import get_stat, analysis, instrument
+import os, sys, time, argparse
+
+#figure name : file name, plot_stat always saves figure1.png to given directory,
+#figures of geo need geopandas and it's imported only when they are rendered
+figures = {
+    "stat" : "figure1.png",
+    "conseq" : "01_nasledky.png",
+    "damage" : "02_priciny.png",
+    "surface" : "03_stav.png",
+    "geo" : "geo1.png",
+    "cluster" : "geo2.png"
+}
+
+def compute_aggregates(cache, names):
+    #store aggregates of figures in cache so workers only read them, arguments are the ones used by plot functions,
+    #geo figures get accidents of JHM instead, returns data passed to workers and time spent on each figure
+    #including loading of data for the first one that needs it
+    data = dict()
+    seconds = dict()
+    for name in names:
+        start = time.perf_counter()
+        if name == "stat":
+            cache.get(get_stat.count_accidents, source="list", columns=["p2a", "p99"])
+        elif name == "conseq":
+            cache.get(analysis.summarize_consequences, "region")
+        elif name == "damage":
+            cache.get(analysis.damage_counts, ["PHA", "JHM", "OLK", "LBK"])
+        elif name == "surface":
+            cache.get(analysis.surface_counts, ["KVK", "PHA", "JHM", "OLK"], range(2016, 2021))
+        else:
+            df = cache.load("dataframe")
+            data[name] = df.loc[df["region"] == "JHM", ["region", "p1", "p5a", "d", "e"]]
+        seconds[name] = time.perf_counter() - start
+    return data, seconds
+
+def render_figure(name, path, folder, cache_filename, aggregates, data, tiles):
+    #render one figure in a worker process, returns time it took
+    start = time.perf_counter()
+    #data are downloaded by the parent, workers only read them
+    cache = AggregateCache(DataDownloader(folder=folder, cache_filename=cache_filename, offline=True), folder=aggregates)
+    if name == "stat":
+        get_stat.plot_stat(cache, os.path.dirname(path))
+    elif name == "conseq":
+        analysis.plot_conseq(cache, path)
+    elif name == "damage":
+        analysis.plot_damage(cache, path)
+    elif name == "surface":
+        analysis.plot_surface(cache, path)
+    else:
+        import geo
+        tile_cache = geo.TileCache(folder=tiles, offline=True) if tiles is not None else None
+        if name == "geo":
+            geo.plot_geo(geo.make_geo(data), path, tiles=tile_cache)
+        else:
+            geo.plot_cluster(geo.make_geo(data), path, tiles=tile_cache)
+    plt.close("all")
+    return time.perf_counter() - start
+
+def render_report(fig_location, names = None, workers = 4, downloader = None, tiles = None):
+    #compute aggregates of all figures and render them in parallel, data are loaded once and only if
+    #some aggregate isn't cached, returns {figure name : (aggregate seconds, render seconds)} and seconds of loading
+    if downloader is None:
+        downloader = DataDownloader()
+    if names is None:
+        names = list(figures)
+    if not os.path.exists(fig_location):
+        os.makedirs(fig_location)
+
+    cache = AggregateCache(downloader, load_all=True)
+    data, aggregate_seconds = compute_aggregates(cache, names)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {name : pool.submit(render_figure, name, fig_location + '/' + figures[name], downloader.folder,
+                                      downloader.cache_filename, cache.folder, data.get(name), tiles) for name in names}
+        timing = dict()
+        for name, future in futures.items():
+            try:
+                timing[name] = (aggregate_seconds[name], future.result())
+                instrument.record_stage("render." + name, timing[name][1])
+            except Exception as e:
+                print("Figure {} couldn't be rendered: {}".format(name, e), file=sys.stderr)
+    return timing, cache.load_seconds
+
+if __name__ == "__main__":
+
+    #create parser for args from command line
+    parser = argparse.ArgumentParser(description="Render all report figures from a single load of the data")
+    parser.add_argument('--fig_location', type=str, metavar='directory', default="report")
+    parser.add_argument('--workers', type=int, metavar='N', default=4)
+    parser.add_argument('--tiles', type=str, metavar='directory', default=None, help="offline basemap tiles, downloaded by contextily if not given")
+    parser.add_argument('--stats', type=str, metavar='file', default=None, help="write JSON with timing of stages, \"-\" for stderr")
+    parser.add_argument('--profile', type=str, metavar='file', default=None, help="write cProfile stats")
+    parser.add_argument('figures', nargs='*', metavar='FIGURE', default=list(figures), help="any of: " + ", ".join(figures))
+    args = parser.parse_args()
+
+    for name in args.figures:
+        if name not in figures:
+            print("Figure {} doesn't exist".format(name), file=sys.stderr)
+            exit(-1)
+
+    if args.stats is not None or args.profile is not None:
+        instrument.enable(args.stats, args.profile)
+
+    timing, load_seconds = render_report(args.fig_location, args.figures, args.workers, tiles=args.tiles)
+    print("load     {:9.3f}".format(load_seconds))
+    print("figure   aggregate[s]  render[s]")
+    for name, (aggregate_seconds, render_seconds) in timing.items():
+        print("{:8} {:12.3f}  {:9.3f}".format(name, aggregate_seconds, render_seconds))